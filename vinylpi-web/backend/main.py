@@ -7,20 +7,20 @@ import asyncio
 import json
 import logging
 import os
-import sys
-from typing import List
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
 
+import orjson
 import pyaudio
 import pylast
-from fastapi import FastAPI, WebSocket, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 
-# Import VinylPi modules
-sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
-from vinylpi_lib import get_device_channels
-from vinylpi_manager import VinylPiManager
+from vinylpi_lib import close_shazam
+from vinylpi_manager import VinylPiManager, encode_frame
 
 # Configure logging
 logging.basicConfig(
@@ -28,7 +28,13 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-app = FastAPI(title="VinylPi Web")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Release the keep-alive connection shared by Shazam requests
+    await close_shazam()
+
+app = FastAPI(title="VinylPi Web", lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -60,47 +66,73 @@ class LastFmConfig(BaseModel):
 # Constants
 CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'config.json')
 
+DEVICES_TTL = 5.0  # Seconds to reuse the audio device list
+LASTFM_TEST_TTL = 30.0  # Seconds to reuse a Last.fm credential check result
+
 # Initialize VinylPi manager
 manager = VinylPiManager()
-connected_clients: List[WebSocket] = []
+_devices_cache: Optional[Tuple[float, List[AudioDevice]]] = None
+_config_cache = {"mtime": None, "data": {}}
+_lastfm_test_cache: Dict[Tuple[str, str, str, str], Tuple[float, bool, Optional[str]]] = {}
+
+def _read_config():
+    with open(CONFIG_FILE, 'r') as f:
+        return json.load(f)
+
+def _write_config(config):
+    with open(CONFIG_FILE, 'wb') as f:
+        f.write(orjson.dumps(config, option=orjson.OPT_INDENT_2))
 
-def load_config():
+async def load_config():
+    """Load the config, re-reading the file only when its mtime changes."""
     try:
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                return json.load(f)
+        mtime = os.stat(CONFIG_FILE).st_mtime
+    except FileNotFoundError:
         return {}
     except Exception as e:
         logging.error(f"Error loading config: {e}")
         return {}
 
-def save_config(config):
+    if mtime != _config_cache["mtime"]:
+        try:
+            _config_cache["data"] = await asyncio.get_running_loop().run_in_executor(
+                None, _read_config
+            )
+            _config_cache["mtime"] = mtime
+        except Exception as e:
+            logging.error(f"Error loading config: {e}")
+            return {}
+    return dict(_config_cache["data"])
+
+async def save_config(config):
     try:
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=4)
+        await asyncio.get_running_loop().run_in_executor(None, _write_config, config)
         return True
     except Exception as e:
         logging.error(f"Error saving config: {e}")
         return False
+    finally:
+        _config_cache["mtime"] = None
 
 def test_lastfm_connection(config):
+    """Verify Last.fm credentials (blocking).
+
+    Creating the network with a password hash requests a session key,
+    which is the credential check itself.
+    """
     try:
-        network = pylast.LastFMNetwork(
+        pylast.LastFMNetwork(
             api_key=config['api_key'],
             api_secret=config['api_secret'],
             username=config['username'],
             password_hash=pylast.md5(config['password'])
         )
-        # Try to fetch user info to verify credentials
-        user = network.get_user(config['username'])
-        user.get_name()
         return True, None
     except Exception as e:
         return False, str(e)
 
-@app.get("/devices", response_model=List[AudioDevice])
-async def get_audio_devices():
-    """Get list of available audio devices."""
+def _enumerate_audio_devices() -> List[AudioDevice]:
+    """Enumerate input devices through PortAudio (blocking)."""
     devices = []
     p = pyaudio.PyAudio()
     try:
@@ -116,10 +148,22 @@ async def get_audio_devices():
         p.terminate()
     return devices
 
+@app.get("/devices", response_model=List[AudioDevice])
+async def get_audio_devices():
+    """Get list of available audio devices."""
+    global _devices_cache
+    now = time.monotonic()
+    if _devices_cache and now - _devices_cache[0] < DEVICES_TTL:
+        return _devices_cache[1]
+
+    devices = await asyncio.get_running_loop().run_in_executor(None, _enumerate_audio_devices)
+    _devices_cache = (now, devices)
+    return devices
+
 @app.get("/lastfm-config")
 async def get_lastfm_config():
     """Get Last.fm configuration."""
-    config = load_config()
+    config = await load_config()
     return {
         "api_key": config.get("api_key", ""),
         "api_secret": config.get("api_secret", ""),
@@ -130,7 +174,7 @@ async def get_lastfm_config():
 @app.post("/lastfm-config")
 async def save_lastfm_config(config: LastFmConfig):
     """Save Last.fm configuration."""
-    current_config = load_config()
+    current_config = await load_config()
     
     # Update config with new values
     current_config.update({
@@ -140,7 +184,7 @@ async def save_lastfm_config(config: LastFmConfig):
         "password": config.password
     })
     
-    if not save_config(current_config):
+    if not await save_config(current_config):
         raise HTTPException(status_code=500, detail="Failed to save configuration")
     
     return {"status": "success"}
@@ -148,11 +192,21 @@ async def save_lastfm_config(config: LastFmConfig):
 @app.get("/test-lastfm")
 async def test_lastfm():
     """Test Last.fm connection with current configuration."""
-    config = load_config()
+    config = await load_config()
     if not all(k in config for k in ["api_key", "api_secret", "username", "password"]):
         return {"success": False, "error": "Missing Last.fm configuration"}
     
-    success, error = test_lastfm_connection(config)
+    key = (config["api_key"], config["api_secret"], config["username"], pylast.md5(config["password"]))
+    now = time.monotonic()
+    cached = _lastfm_test_cache.get(key)
+    if cached and now - cached[0] < LASTFM_TEST_TTL:
+        _, success, error = cached
+    else:
+        success, error = await asyncio.get_running_loop().run_in_executor(
+            None, test_lastfm_connection, config
+        )
+        _lastfm_test_cache.clear()
+        _lastfm_test_cache[key] = (now, success, error)
     return {"success": success, "error": error}
 
 @app.get("/status")
@@ -161,7 +215,8 @@ async def get_status():
     return {
         "running": manager.running,
         "current_track": manager.current_track,
-        "device_index": manager.current_device
+        "device_index": manager.current_device,
+        "debug_info": manager.get_debug_info()
     }
 
 class StartRequest(BaseModel):
@@ -179,35 +234,46 @@ async def stop_vinylpi():
     success = await manager.stop()
     return {"status": "stopped" if success else "not_running"}
 
+async def _sender(websocket: WebSocket, queue: asyncio.Queue):
+    """Drain a client's message queue onto its WebSocket.
+
+    Messages that queued up while a send was in progress are merged into
+    a single frame. A failed send unregisters the client straight away so
+    broadcasts stop queueing frames for a dead connection.
+    """
+    try:
+        while True:
+            batch = [await queue.get()]
+            while True:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            if len(batch) == 1:
+                payload = batch[0][1]
+            else:
+                payload = encode_frame([message for message, _ in batch])
+            await websocket.send_bytes(payload)
+    except (WebSocketDisconnect, RuntimeError, ConnectionError) as e:
+        logging.debug(f"WebSocket send failed, dropping client: {e}")
+        manager.remove_client(websocket)
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for real-time updates."""
     await websocket.accept()
-    connected_clients.append(websocket)
-    
-    async def track_listener(track):
-        if track:
-            try:
-                await websocket.send_json({"type": "track_update", "data": track})
-            except:
-                pass
-    
-    async def status_listener(status):
-        try:
-            await websocket.send_json({"type": "status_update", "data": status})
-        except:
-            pass
-    
-    # Add listeners
-    manager.add_track_listener(track_listener)
-    manager.add_status_listener(status_listener)
-    
+    queue = manager.add_client(websocket)
+    sender = asyncio.create_task(_sender(websocket, queue))
+
     try:
         while True:
             # Keep connection alive
             await websocket.receive_text()
-    except:
-        connected_clients.remove(websocket)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        manager.remove_client(websocket)
+        sender.cancel()
 
 # Serve frontend static files - mount this last
 static_dir = os.path.join(os.path.dirname(__file__), "static")
@@ -215,4 +281,15 @@ app.mount("/", StaticFiles(directory=static_dir, html=True), name="frontend")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    # uvicorn picks uvloop and httptools automatically when they are installed
+    workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+    if workers > 1:
+        logging.warning(
+            "Starting %d workers: each worker has its own VinylPiManager, so /ws "
+            "clients only receive updates from the worker they are connected to",
+            workers
+        )
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, loop="auto", http="auto", workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="auto")
@@ -6,41 +6,27 @@ Includes utilities for audio device management, file I/O, and user configuration
 
 import asyncio
 import collections
-import io
+import functools
 import json
 import os
+import struct
 import time
-import wave
+from typing import Optional
 
+import aiohttp
 import numpy as np
+import orjson
 import pyaudio
 import pylast
+from aiohttp_retry import ExponentialRetry, RetryClient
 from shazamio import Shazam
+from shazamio.interfaces.client import HTTPClientInterface
 
 # Audio settings
 CHUNK = 2048  # Back to original chunk size
 FORMAT = pyaudio.paInt16  # Back to int16 for better compatibility
 RATE = 44100  # Standard CD quality rate
-
-def get_device_channels(device_index: int) -> int:
-    """Get the number of input channels supported by the device.
-
-    Args:
-        device_index: Index of the audio device
-
-    Returns:
-        int: Number of input channels (defaults to 2 if cannot determine)
-    """
-    try:
-        p = pyaudio.PyAudio()
-        device_info = p.get_device_info_by_index(device_index)
-        max_channels = int(device_info.get('maxInputChannels', 2))
-        if max_channels <= 0:
-            max_channels = 2  # Default to stereo
-        p.terminate()
-        return max_channels
-    except Exception:
-        return 2  # Default to stereo if cannot determine
+SHAZAM_RATE = 16000  # Shazam fingerprints 16 kHz mono audio
 
 # Recognition settings
 RECORD_SECONDS = 5  # Shorter recording time for faster detection
@@ -57,16 +43,24 @@ SILENCE_THRESHOLD = 100  # RMS threshold for silence detection
 SILENCE_CHECK_DURATION = 0.5  # Duration in seconds to check for silence
 SILENCE_CHECK_INTERVAL = 1  # How often to check for silence when in standby
 
+_config_cache = {"mtime": None, "data": {}}
+
 def load_config():
     """Load configuration from JSON file.
 
+    The parsed file is reused until its mtime changes.
+
     Returns:
         dict: Configuration including Last.fm credentials
     """
     try:
-        if os.path.exists(CONFIG_FILE):
+        mtime = os.stat(CONFIG_FILE).st_mtime
+        if mtime != _config_cache["mtime"]:
             with open(CONFIG_FILE, 'r') as f:
-                return json.load(f)
+                _config_cache["data"] = json.load(f)
+            _config_cache["mtime"] = mtime
+        return dict(_config_cache["data"])
+    except FileNotFoundError:
         return {}
     except Exception as e:
         print(f"Error loading config: {e}")
@@ -77,22 +71,32 @@ def load_config():
 def list_audio_devices():
     """List all available audio input devices.
 
-    Prints device index and name for each input device found.
+    Prints device index and name for each input device found. A fresh
+    PortAudio session is opened each time so devices plugged in after
+    startup are listed.
     """
     p = pyaudio.PyAudio()
-    device_count = p.get_device_count()
-    for i in range(device_count):
-        device_info = p.get_device_info_by_index(i)
-        if device_info["maxInputChannels"] > 0:
-            device_name = device_info["name"]
-            print(f"Device Index {i}: {device_name}")
-    p.terminate()
+    try:
+        device_count = p.get_device_count()
+        for i in range(device_count):
+            device_info = p.get_device_info_by_index(i)
+            if device_info["maxInputChannels"] > 0:
+                device_name = device_info["name"]
+                print(f"Device Index {i}: {device_name}")
+    finally:
+        p.terminate()
+
 
 
+# Last network built, keyed by the credentials it was built from
+_network_cache = {"key": None, "network": None}
 
 def get_lastfm_network():
     """Initialize and return a Last.fm network instance.
 
+    The network (and its session key) is reused until the configured
+    credentials change.
+
     Returns:
         pylast.LastFMNetwork: Authenticated Last.fm network instance or None if not configured
     """
@@ -109,13 +113,17 @@ def get_lastfm_network():
         # Check if any fields are empty strings
         if any(not config[k] for k in required_fields):
             return None
-        
-        return pylast.LastFMNetwork(
-            api_key=config["api_key"],
-            api_secret=config["api_secret"],
-            username=config["username"],
-            password_hash=pylast.md5(config["password"])
-        )
+
+        key = tuple(config[k] for k in required_fields)
+        if key != _network_cache["key"]:
+            _network_cache["network"] = pylast.LastFMNetwork(
+                api_key=config["api_key"],
+                api_secret=config["api_secret"],
+                username=config["username"],
+                password_hash=pylast.md5(config["password"])
+            )
+            _network_cache["key"] = key
+        return _network_cache["network"]
     except Exception:
         return None
 
@@ -133,14 +141,16 @@ def log_song_to_lastfm(network: pylast.LastFMNetwork, artist: str, title: str,
     Returns:
         tuple: The logged song as (artist, title) if successful, or last_logged_song if not
     """
+    # Repeats of the last song are the common case; skip them before any
+    # other work, logging only at debug level
+    if (artist, title) == last_logged_song:
+        logger.debug("Duplicate song detected. Not logging: %s by %s", title, artist)
+        return last_logged_song
+
     if artist and title and artist != "None" and title != "None":
-        if (artist, title) == last_logged_song:
-            logger.info(f"Duplicate song detected. Not logging: {title} by {artist}")
-            return last_logged_song
-        
         try:
             network.scrobble(artist=artist, title=title, timestamp=int(time.time()))
-            logger.info(f"Logged to Last.fm: {title} by {artist}")
+            logger.info("Logged to Last.fm: %s by %s", title, artist)
             return (artist, title)
         except Exception as e:
             logger.error(f"Error logging to Last.fm: {e}")
@@ -148,35 +158,116 @@ def log_song_to_lastfm(network: pylast.LastFMNetwork, artist: str, title: str,
         logger.info("Song not logged: Invalid artist or title")
     return last_logged_song
 
-async def recognize_song(audio_data: bytes, verbose: bool, logger) -> tuple:
+def to_shazam_pcm(audio_data) -> np.ndarray:
+    """Resample mono int16 audio from RATE to SHAZAM_RATE.
+
+    Shazam resamples to 16 kHz before fingerprinting anyway, so doing it
+    here makes the WAV it has to decode almost three times smaller.
+
+    Args:
+        audio_data: Raw int16 audio data at RATE (bytes or a NumPy view)
+
+    Returns:
+        np.ndarray: int16 samples at SHAZAM_RATE
+    """
+    samples = np.frombuffer(audio_data, dtype=np.int16)
+    step = RATE / SHAZAM_RATE
+    # Box filter over one output period to limit aliasing, then pick
+    # samples on the target grid; both keep values within int16 range
+    width = int(np.ceil(step))
+    filtered = np.convolve(samples, np.full(width, 1.0 / width, dtype=np.float32), mode='same')
+    positions = np.arange(0, len(filtered) - 1, step)
+    return np.interp(positions, np.arange(len(filtered)), filtered).astype(np.int16)
+
+_WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+
+@functools.lru_cache(maxsize=8)
+def _wav_header(data_size: int) -> bytes:
+    """Build the 44-byte WAV header for data_size bytes of 16 kHz mono int16 audio."""
+    sample_width = pyaudio.get_sample_size(FORMAT)
+    return _WAV_HEADER.pack(
+        b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16,
+        1, 1, SHAZAM_RATE, SHAZAM_RATE * sample_width, sample_width, sample_width * 8,
+        b"data", data_size
+    )
+
+class ShazamSession(HTTPClientInterface):
+    """shazamio HTTP client that keeps one aiohttp session for all requests.
+
+    shazamio's default client opens a new session, and with it a new TLS
+    connection, for every recognition.
+    """
+
+    def __init__(self):
+        self._client: Optional[RetryClient] = None
+
+    async def request(self, method: str, url: str, *args, **kwargs) -> dict:
+        """Send a GET or POST request and decode the JSON response."""
+        if self._client is None:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=4, ttl_dns_cache=300, keepalive_timeout=300)
+            )
+            self._client = RetryClient(
+                client_session=session,
+                retry_options=ExponentialRetry(
+                    attempts=12, max_timeout=60, statuses={500, 502, 503, 504, 429}
+                ),
+            )
+        content_type = args[0] if args else "application/json"
+        async with self._client.request(method.upper(), url, **kwargs) as resp:
+            return await resp.json(loads=orjson.loads, content_type=content_type)
+
+    async def close(self) -> None:
+        """Close the underlying session."""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+# Created on first use and reused for every recognition
+_SHAZAM = None
+_SHAZAM_SESSION = ShazamSession()
+
+def _get_shazam() -> Shazam:
+    """Return the shared Shazam client, creating it on first use."""
+    global _SHAZAM
+    if _SHAZAM is None:
+        _SHAZAM = Shazam(http_client=_SHAZAM_SESSION)
+    return _SHAZAM
+
+async def close_shazam() -> None:
+    """Close the HTTP session shared by Shazam requests."""
+    await _SHAZAM_SESSION.close()
+
+async def recognize_song(audio_data, verbose: bool, logger) -> tuple:
     """Recognize a song from audio data using Shazam.
 
     Args:
-        audio_data: Raw audio data
+        audio_data: Raw int16 audio data (bytes or a NumPy view)
         verbose: Whether to log debug information
         logger: Logger instance
 
     Returns:
         tuple: (artist, title, confidence) of the recognized song, or (None, None, 0) if not recognized
     """
-    shazam = Shazam()
-    with io.BytesIO() as wav_file:
-        wav = wave.open(wav_file, 'wb')
-        frame_size = pyaudio.get_sample_size(FORMAT)
-        total_bytes = len(audio_data)
-        
+    # Don't spend a Shazam request on a gap between tracks
+    audio_level = get_audio_level(audio_data)
+    if audio_level < SILENCE_THRESHOLD:
         if verbose:
-            logger.debug(f"Audio data: {total_bytes} bytes, {frame_size} bytes per sample")
-            logger.debug(f"Sample rate: {RATE} Hz, Recording duration: {RECORD_SECONDS} seconds")
-        
-        # Always use mono for Shazam
-        wav.setnchannels(1)
-        wav.setsampwidth(frame_size)
-        wav.setframerate(RATE)
-        wav.writeframes(audio_data)
-        wav.close()
-        wav_data = wav_file.getvalue()
-    
+            logger.debug(f"Audio level {audio_level:.1f} below {SILENCE_THRESHOLD}, skipping recognition")
+        return None, None, 0
+
+    shazam = _get_shazam()
+    total_bytes = memoryview(audio_data).nbytes
+
+    if verbose:
+        logger.debug(f"Audio data: {total_bytes} bytes, {pyaudio.get_sample_size(FORMAT)} bytes per sample")
+        logger.debug(f"Sample rate: {RATE} Hz, Recording duration: {RECORD_SECONDS} seconds")
+
+    # Always use mono for Shazam; once resampled (off the event loop) the
+    # WAV file is just the header followed by the samples
+    pcm = await asyncio.get_running_loop().run_in_executor(None, to_shazam_pcm, audio_data)
+    wav_data = b"".join((_wav_header(pcm.nbytes), pcm))
+
     try:
         result = await shazam.recognize(wav_data)
         if verbose:
@@ -207,88 +298,112 @@ async def recognize_song(audio_data: bytes, verbose: bool, logger) -> tuple:
     except Exception as e:
         if verbose:
             logger.error(f"Error in song recognition: {e}")
-            logger.debug("Audio data size: %d bytes", len(audio_data))
+            logger.debug("Audio data size: %d bytes", total_bytes)
     return None, None, 0
 
-def get_audio_level(audio_stream: pyaudio.Stream, duration: float) -> float:
-    """Calculate the RMS level of audio over a given duration.
-
-    Args:
-        audio_stream: PyAudio stream to read from
-        duration: Duration in seconds to analyze
+class AudioRingBuffer:
+    """Bounded buffer holding the most recent seconds of int16 audio.
 
-    Returns:
-        float: RMS level of the audio
+    Samples are written in place into a preallocated array that wraps
+    around, so memory stays fixed however long the session runs. Sizes
+    are kept to whole chunks so chunk-sized writes never straddle the end.
     """
-    frames = []
-    for _ in range(0, int(RATE / CHUNK * duration)):
-        data = audio_stream.read(CHUNK, exception_on_overflow=False)
-        frames.append(data)
-
-    # Convert to int16 array
-    audio_data = np.frombuffer(b''.join(frames), dtype=np.int16)
-    # Calculate RMS, ensuring we don't have negative values under the sqrt
-    squared = np.square(audio_data.astype(np.float64))
-    mean_squared = np.mean(squared) if squared.size > 0 else 0
-    rms = np.sqrt(mean_squared) if mean_squared > 0 else 0
-    return float(rms)
 
-
-
-async def check_song_consistency(recognize_song_func, audio_stream: pyaudio.Stream,
-                               verbose: bool, logger) -> tuple:
-    """Check if a song is consistently recognized across multiple samples.
+    def __init__(self, seconds: float):
+        size = max(1, int(RATE * seconds) // CHUNK) * CHUNK
+        self._buf = np.zeros(size, dtype=np.int16)
+        self._pos = 0
+        self._filled = 0
+
+    def write(self, data: bytes) -> None:
+        """Append raw int16 audio, overwriting the oldest samples."""
+        samples = np.frombuffer(data, dtype=np.int16)[-len(self._buf):]
+        n = len(samples)
+        end = self._pos + n
+        if end <= len(self._buf):
+            self._buf[self._pos:end] = samples
+        else:
+            split = len(self._buf) - self._pos
+            self._buf[self._pos:] = samples[:split]
+            self._buf[:n - split] = samples[split:]
+        self._pos = end % len(self._buf)
+        self._filled = min(len(self._buf), self._filled + n)
+
+    def tail(self, seconds: float) -> np.ndarray:
+        """Return the most recent audio.
+
+        The result is a view into the buffer unless the window wraps
+        around its end, in which case the two halves are concatenated.
+        """
+        n = min(int(RATE * seconds), self._filled)
+        start = self._pos - n
+        if start >= 0:
+            return self._buf[start:self._pos]
+        return np.concatenate((self._buf[start:], self._buf[:self._pos]))
+
+# Scratch space for level calculations, reused across calls
+_LEVEL_SCRATCH = np.empty(CHUNK * 8, dtype=np.float32)
+
+def get_audio_level(audio_data) -> float:
+    """Calculate the RMS level of raw int16 audio.
 
     Args:
-        recognize_song_func: Function to recognize songs
-        audio_stream: Audio input stream
-        verbose: Whether to log debug information
-        logger: Logger instance
+        audio_data: Raw int16 audio data (bytes or a NumPy view)
 
     Returns:
-        tuple: (artist, title) if a song is consistently recognized, else (None, None)
+        float: RMS level of the audio
     """
-    song_checks = []
+    samples = np.frombuffer(audio_data, dtype=np.int16)
+    if not samples.size:
+        return 0.0
+    if samples.size <= _LEVEL_SCRATCH.size:
+        scratch = _LEVEL_SCRATCH[:samples.size]
+    else:
+        scratch = np.empty(samples.size, dtype=np.float32)
+    np.copyto(scratch, samples, casting='unsafe')
+    return float(np.sqrt(np.dot(scratch, scratch) / samples.size))
 
-    for i in range(CONSISTENCY_CHECKS):
-        if verbose:
-            logger.debug(f"Consistency check {i+1}/{CONSISTENCY_CHECKS}")
-        
-        frames = []
-        for _ in range(0, int(RATE / CHUNK * RECORD_SECONDS)):
-            data = audio_stream.read(CHUNK, exception_on_overflow=False)
-            frames.append(data)
-
-        audio_data = b''.join(frames)
-        artist, title, confidence = await recognize_song_func(audio_data)
-        if artist and title and confidence >= CONFIDENCE_THRESHOLD:
-            song_checks.append((artist, title))
-            if verbose:
-                logger.debug(f"Found match: {title} by {artist}")
 
-        # Don't wait after the last check
-        if i < CONSISTENCY_CHECKS - 1:
-            await asyncio.sleep(CHECK_INTERVAL)
+class SongTally:
+    """Sliding consistency count over the most recent recognition results.
 
-    song_counts = collections.Counter(song_checks)
-    most_common = song_counts.most_common(1)
+    Each new result pushes the oldest one out, so a song is reported as
+    soon as it fills enough of the window.
+    """
 
-    if most_common:
-        matches = most_common[0][1]
-        if matches >= CONSISTENCY_THRESHOLD:
-            if verbose:
-                logger.debug(
-                    f"Consistent song detected: {most_common[0][0][1]} by {most_common[0][0][0]} "
-                    f"({matches}/{CONSISTENCY_CHECKS} matches)"
-                )
+    def __init__(self, size: int = CONSISTENCY_CHECKS):
+        self._recent = collections.deque(maxlen=size)
+        self._counts = collections.Counter()
+
+    def add(self, artist, title, confidence) -> tuple:
+        """Record a recognition result.
+
+        Args:
+            artist: Recognized artist, or None
+            title: Recognized title, or None
+            confidence: Confidence of the match
+
+        Returns:
+            tuple: (artist, title) if a song is consistently recognized, else (None, None)
+        """
+        if len(self._recent) == self._recent.maxlen:
+            oldest = self._recent[0]
+            if oldest:
+                self._counts[oldest] -= 1
+                if not self._counts[oldest]:
+                    del self._counts[oldest]
+
+        song = (artist, title) if artist and title and confidence >= CONFIDENCE_THRESHOLD else None
+        self._recent.append(song)
+        if song:
+            self._counts[song] += 1
+
+        most_common = self._counts.most_common(1)
+        if most_common and most_common[0][1] >= CONSISTENCY_THRESHOLD:
             return most_common[0][0]
-        elif verbose:
-            logger.debug(f"Song had {matches} matches but needed {CONSISTENCY_THRESHOLD}")
-    
-    if verbose:
-        logger.debug("No consistent song detected")
-    return None, None
-
-
-
+        return None, None
 
+    def clear(self) -> None:
+        """Forget all results, e.g. after the audio went silent."""
+        self._recent.clear()
+        self._counts.clear()
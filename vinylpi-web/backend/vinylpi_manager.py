@@ -6,22 +6,65 @@ Manages the VinylPi process and provides an interface for the web API.
 import asyncio
 import json
 import logging
-from datetime import datetime
-from typing import Optional, List, Callable
+import math
+import re
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
 import os
-import sys
 
-# Add project root to Python path
-project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-sys.path.append(project_root)
+import orjson
 
 from vinylpi_lib import (
-    CHUNK, FORMAT, RATE, CHECK_INTERVAL,
-    get_device_channels, get_lastfm_network, recognize_song,
-    check_song_consistency, get_audio_level
+    CHUNK, FORMAT, RATE, CHECK_INTERVAL, CONFIG_FILE, RECORD_SECONDS,
+    get_lastfm_network, recognize_song,
+    get_audio_level, AudioRingBuffer, SongTally
 )
 import pyaudio
 
+CLIENT_QUEUE_SIZE = 16  # Pending messages kept per WebSocket client
+COMPRESS_MIN_SIZE = 512  # Broadcast payloads larger than this are zlib-compressed
+AUDIO_LEVEL_INTERVAL = 0.5  # Minimum seconds between audio level broadcasts
+
+# One-byte tags prefixed to binary WebSocket frames
+FRAME_JSON = 0
+FRAME_ZLIB = 1
+_LASTFM_CACHE_MAX = 512  # Tracks whose Last.fm metadata is kept in memory
+LASTFM_CACHE_FILE = os.path.join(os.path.dirname(CONFIG_FILE), 'lastfm_cache.json')
+_LASTFM_CACHE_TTL = 30 * 24 * 3600  # Drop persisted metadata older than 30 days
+_CACHE_FLUSH_INTERVAL = 10  # Minimum seconds between cache writes
+SCROBBLE_QUEUE_SIZE = 64  # Pending Last.fm updates
+SCROBBLE_RETRIES = 4  # Attempts per Last.fm update, with exponential backoff
+
+# Adaptive detection pacing
+MAX_INTERVAL_FACTOR = 4  # Stable playback stretches CHECK_INTERVAL up to this factor
+LEVEL_WINDOW_PLAYING = 0.05  # Seconds of audio sampled for the level while a track plays
+LEVEL_WINDOW_IDLE = 0.2  # Seconds of audio sampled for the level while idle
+
+AUDIO_BUFFER_SECONDS = 10  # Recent audio kept for recognition
+AUDIO_QUEUE_SIZE = int(RATE / CHUNK * AUDIO_BUFFER_SECONDS)  # Captured chunks awaiting the loop
+AUDIO_READ_TIMEOUT = 2.0  # Seconds without a chunk before capture is treated as stopped
+RECOGNIZE_CHUNKS = int(RATE / CHUNK * RECORD_SECONDS)  # New audio needed before recognizing again
+
+_YEAR_RE = re.compile(r'\b(19|20)\d{2}\b')
+
+def encode_frame(messages: List[bytes]) -> bytes:
+    """Encode JSON-encoded messages as one tagged binary WebSocket frame.
+
+    The frame body is a JSON array of the messages, zlib-compressed when
+    it is larger than COMPRESS_MIN_SIZE.
+    """
+    data = b'[' + b','.join(messages) + b']'
+    if len(data) > COMPRESS_MIN_SIZE:
+        return bytes((FRAME_ZLIB,)) + zlib.compress(data, 1)
+    return bytes((FRAME_JSON,)) + data
+
+def _fmt_timestamp(ts: float) -> str:
+    """Format a Unix timestamp as an ISO 8601 UTC string."""
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec='seconds')
+
 class VinylPiManager:
     def __init__(self):
         # Set up logging first
@@ -37,20 +80,32 @@ class VinylPiManager:
         self.current_device: Optional[int] = None
         self.running: bool = False
         self.current_track: Optional[dict] = None
-        self.track_listeners: List[Callable] = []
-        self.status_listeners: List[Callable] = []
+        self.connected_clients: Dict[object, asyncio.Queue] = {}
         self._task: Optional[asyncio.Task] = None
+        self._last_status: Optional[tuple] = None
+        self._last_level_sent = 0.0
+        self._scrobble_q: Optional[asyncio.Queue] = None
+        self._scrobble_task: Optional[asyncio.Task] = None
         self.debug_info = {
             'audio_level': 0,
-            'last_detection_time': None,
+            'last_detection_time_ts': None,
             'detection_count': 0,
             'last_error': None
         }
         self.stream = None
         self.pyaudio = None
+        self._audio_buffer = AudioRingBuffer(AUDIO_BUFFER_SECONDS)
+        self._song_tally = SongTally()
+        self._audio_queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
         self.lastfm_network = None
         self.no_song_detected_count = 0
+        self._stable_ticks = 0
+        self._fresh_chunks = 0  # Chunks captured since the last recognized window
         self.last_logged_song = None
+        self._lastfm_cache: "OrderedDict[Tuple[str, str], Tuple[float, dict]]" = self._load_cache()
+        self._cache_flush_task: Optional[asyncio.Task] = None
+        self._last_cache_flush = 0.0
         
         # Try to initialize Last.fm if configured
         try:
@@ -58,134 +113,303 @@ class VinylPiManager:
         except Exception as e:
             self.logger.error(f"Error initializing Last.fm: {e}")
         
-    def add_track_listener(self, listener: Callable):
-        """Add a listener for track updates."""
-        self.track_listeners.append(listener)
-        
-    def add_status_listener(self, listener: Callable):
-        """Add a listener for status updates."""
-        self.status_listeners.append(listener)
-        
-    async def _notify_track_listeners(self):
-        """Notify all track listeners of the current track."""
-        for listener in self.track_listeners:
+    def add_client(self, websocket) -> asyncio.Queue:
+        """Register a WebSocket client and return its outgoing message queue."""
+        queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self.connected_clients[websocket] = queue
+        return queue
+
+    def remove_client(self, websocket):
+        """Unregister a WebSocket client."""
+        self.connected_clients.pop(websocket, None)
+
+    def get_debug_info(self) -> dict:
+        """Return debug info with timestamps formatted for clients."""
+        info = dict(self.debug_info)
+        ts = info.pop('last_detection_time_ts')
+        info['last_detection_time'] = _fmt_timestamp(ts) if ts else None
+        return info
+
+    async def broadcast(self, type_: str, data):
+        """Queue a message for every connected WebSocket client.
+
+        The message and its single-message frame are encoded once and the
+        same bytes are put on each client's queue as a (message, frame)
+        pair. A full queue drops its oldest message, so a slow client never
+        holds up the others.
+        """
+        if not self.connected_clients:
+            return
+        message = orjson.dumps({"type": type_, "data": data}, option=orjson.OPT_SERIALIZE_NUMPY)
+        item = (message, encode_frame([message]))
+        for queue in list(self.connected_clients.values()):
             try:
-                await listener(self.current_track)
-            except:
-                pass
-                
-    async def _notify_status_listeners(self):
-        """Notify all status listeners of the current status."""
+                queue.put_nowait(item)
+            except asyncio.QueueFull:
+                queue.get_nowait()
+                queue.put_nowait(item)
+
+    async def _broadcast_track(self):
+        """Broadcast the current track to all clients."""
+        if self.current_track:
+            await self.broadcast("track_update", self.current_track)
+
+    async def _broadcast_status(self):
+        """Broadcast the current status to all clients if it has changed."""
+        track = self.current_track or {}
+        snapshot = (self.running, track.get('artist'), track.get('title'), self.current_device)
+        if snapshot == self._last_status:
+            return
+        self._last_status = snapshot
+
         status = {
             'running': self.running,
             'current_track': self.current_track,
             'device_index': self.current_device
         }
-        for listener in self.status_listeners:
+        await self.broadcast("status_update", status)
+
+    def _extract_track_meta(self, track_info: dict) -> dict:
+        """Extract the metadata we display from a Last.fm track info response."""
+        album_name = None
+        album_year = None
+        track_duration = None
+        track_tags = []
+        track_listeners = None
+        track_playcount = None
+
+        # Get album info
+        if 'album' in track_info:
+            album_name = track_info['album']['title']
+            # Prefer the album's own release date when Last.fm provides one
+            release_match = _YEAR_RE.search(track_info['album'].get('releasedate') or '')
+            if release_match:
+                album_year = release_match.group(0)
+
+        # Get track duration
+        if 'duration' in track_info:
+            track_duration = int(track_info['duration']) // 1000  # Convert to seconds
+
+        # Get track tags
+        if 'toptags' in track_info and 'tag' in track_info['toptags']:
+            track_tags = [tag['name'] for tag in track_info['toptags']['tag'][:3]]
+
+        # Get popularity info
+        if 'listeners' in track_info:
+            track_listeners = track_info['listeners']
+        if 'playcount' in track_info:
+            track_playcount = track_info['playcount']
+
+        # Try to get release year from wiki or album info
+        if album_year is None and 'wiki' in track_info:
             try:
-                await listener(status)
-            except:
-                pass
-                
+                # Look for year patterns in the wiki text
+                year_match = _YEAR_RE.search(track_info['wiki']['content'])
+                album_year = year_match.group(0) if year_match else None
+            except (KeyError, TypeError) as e:
+                self.logger.error(f"Error parsing wiki: {e}")
+
+        return {
+            'album': {
+                'name': album_name,
+                'year': album_year
+            } if album_name else None,
+            'duration': track_duration,
+            'tags': track_tags,
+            'listeners': track_listeners,
+            'playcount': track_playcount
+        }
+
+    def _load_cache(self) -> "OrderedDict[Tuple[str, str], Tuple[float, dict]]":
+        """Load persisted Last.fm metadata, skipping expired entries."""
+        cache = OrderedDict()
+        try:
+            with open(LASTFM_CACHE_FILE, 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return cache
+        except Exception as e:
+            self.logger.error(f"Error loading Last.fm cache: {e}")
+            return cache
+
+        cutoff = time.time() - _LASTFM_CACHE_TTL
+        for entry in entries[-_LASTFM_CACHE_MAX:]:
+            if entry['ts'] >= cutoff:
+                cache[tuple(entry['key'])] = (entry['ts'], entry['value'])
+        return cache
+
+    def _write_cache(self, entries: list):
+        """Atomically write cache entries to disk."""
+        tmp_path = LASTFM_CACHE_FILE + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(entries))
+        os.replace(tmp_path, LASTFM_CACHE_FILE)
+
+    async def _flush_cache(self):
+        """Persist the Last.fm cache, at most once per flush interval."""
+        delay = self._last_cache_flush + _CACHE_FLUSH_INTERVAL - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._last_cache_flush = time.monotonic()
+
+        entries = [{'key': list(key), 'value': meta, 'ts': ts}
+                   for key, (ts, meta) in self._lastfm_cache.items()]
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_cache, entries)
+        except Exception as e:
+            self.logger.error(f"Error saving Last.fm cache: {e}")
+
+    def _schedule_cache_flush(self):
+        """Schedule a cache write unless one is already pending."""
+        if self._cache_flush_task is None or self._cache_flush_task.done():
+            self._cache_flush_task = asyncio.create_task(self._flush_cache())
+
+    async def _get_track_meta(self, artist: str, title: str) -> dict:
+        """Get Last.fm metadata for a track, using the LRU cache."""
+        key = (artist.lower(), title.lower())
+        cached = self._lastfm_cache.get(key)
+        if cached is not None:
+            self._lastfm_cache.move_to_end(key)
+            return cached[1]
+
+        # Get track info using Last.fm API, off the event loop
+        track_info = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.lastfm_network.get_track(artist, title).get_info())
+        self.logger.info(f"Raw track info: {track_info}")
+
+        meta = self._extract_track_meta(track_info)
+        self._lastfm_cache[key] = (time.time(), meta)
+        if len(self._lastfm_cache) > _LASTFM_CACHE_MAX:
+            self._lastfm_cache.popitem(last=False)
+        self._schedule_cache_flush()
+        return meta
+
+    def _send_scrobble(self, item: tuple):
+        """Send a single queued update to Last.fm (blocking)."""
+        kind, song = item[0], item[1]
+        if kind == 'now_playing':
+            self.lastfm_network.update_now_playing(artist=song[0], title=song[1])
+        else:
+            self.lastfm_network.scrobble(artist=song[0], title=song[1], timestamp=item[2])
+
+    async def _scrobble_worker(self):
+        """Drain the scrobble queue, retrying failed updates with backoff."""
+        while True:
+            item = await self._scrobble_q.get()
+            try:
+                for attempt in range(SCROBBLE_RETRIES):
+                    try:
+                        await asyncio.get_running_loop().run_in_executor(
+                            None, self._send_scrobble, item
+                        )
+                        break
+                    except Exception as e:
+                        self.logger.error(f"Last.fm scrobbling error: {e}")
+                        if attempt < SCROBBLE_RETRIES - 1:
+                            await asyncio.sleep(2 ** attempt)
+            finally:
+                self._scrobble_q.task_done()
+
+    def _queue_scrobble(self, *item):
+        """Queue an update for the scrobble worker without waiting on Last.fm."""
+        try:
+            self._scrobble_q.put_nowait(item)
+        except asyncio.QueueFull:
+            self.logger.warning(f"Scrobble queue full, dropping {item[0]} for {item[1]}")
+
+    async def _broadcast_audio_level(self, level: float):
+        """Broadcast the audio level, rate-limited to AUDIO_LEVEL_INTERVAL."""
+        now = time.monotonic()
+        if now - self._last_level_sent < AUDIO_LEVEL_INTERVAL:
+            return
+        self._last_level_sent = now
+        await self.broadcast("audio_level", {'audio_level': level})
+
     async def _process_song_detection(self, song):
         """Process a detected song."""
-        if song:
-            if song != (self.current_track['artist'] if self.current_track else None,
-                       self.current_track['title'] if self.current_track else None):
+        if song and song[0] and song[1]:
+            if song == (self.current_track['artist'] if self.current_track else None,
+                        self.current_track['title'] if self.current_track else None):
+                self._stable_ticks += 1
+            else:
+                self._stable_ticks = 0
                 # Create basic track info
                 self.current_track = {
                     'artist': song[0],
                     'title': song[1],
                     'confidence': 0.9,
-                    'timestamp': datetime.now().isoformat()
+                    'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds')
                 }
 
                 # Try to get additional info from Last.fm if configured
                 if self.lastfm_network:
+                    # Scrobble to Last.fm in the background
+                    self._queue_scrobble('now_playing', song)
+                    if song != self.last_logged_song:
+                        self._queue_scrobble('scrobble', song, int(time.time()))
+                        self.last_logged_song = song
+
                     try:
-                        # Get track info using Last.fm API
-                        track = self.lastfm_network.get_track(song[0], song[1])
-                        track_info = track.get_info()
-                        self.logger.info(f"Raw track info: {track_info}")
-                        
-                        # Extract metadata
-                        album_name = None
-                        album_year = None
-                        track_duration = None
-                        track_tags = []
-                        track_listeners = None
-                        track_playcount = None
-                        
-                        # Get album info
-                        if 'album' in track_info:
-                            album_name = track_info['album']['title']
-                        
-                        # Get track duration
-                        if 'duration' in track_info:
-                            track_duration = int(track_info['duration']) // 1000  # Convert to seconds
-                        
-                        # Get track tags
-                        if 'toptags' in track_info and 'tag' in track_info['toptags']:
-                            track_tags = [tag['name'] for tag in track_info['toptags']['tag'][:3]]
-                        
-                        # Get popularity info
-                        if 'listeners' in track_info:
-                            track_listeners = track_info['listeners']
-                        if 'playcount' in track_info:
-                            track_playcount = track_info['playcount']
-                        
-                        # Try to get release year from wiki or album info
-                        if 'wiki' in track_info:
-                            try:
-                                wiki_text = track_info['wiki']['content']
-                                # Look for year patterns in the wiki text
-                                import re
-                                year_match = re.search(r'\b(19|20)\d{2}\b', wiki_text)
-                                if year_match:
-                                    album_year = year_match.group(0)
-                            except Exception as e:
-                                self.logger.error(f"Error parsing wiki: {e}")
-                        
                         # Update track info with additional data
-                        self.current_track.update({
-                            'album': {
-                                'name': album_name,
-                                'year': album_year
-                            } if album_name else None,
-                            'duration': track_duration,
-                            'tags': track_tags,
-                            'listeners': track_listeners,
-                            'playcount': track_playcount
-                        })
-                        
-                        # Scrobble to Last.fm
-                        try:
-                            self.lastfm_network.update_now_playing(artist=song[0], title=song[1])
-                            if song != self.last_logged_song:
-                                self.lastfm_network.scrobble(artist=song[0], title=song[1],
-                                                            timestamp=int(datetime.now().timestamp()))
-                                self.last_logged_song = song
-                        except Exception as e:
-                            self.logger.error(f"Last.fm scrobbling error: {e}")
+                        self.current_track.update(await self._get_track_meta(song[0], song[1]))
                     except Exception as e:
                         self.logger.error(f"Error fetching Last.fm track info: {e}")
                 else:
                     self.logger.debug("Last.fm not configured, skipping metadata fetch and scrobbling")
 
-                await self._notify_track_listeners()
+                await self._broadcast_track()
                         
             self.no_song_detected_count = 0
         else:
+            self._stable_ticks = 0
             self.no_song_detected_count += 1
             if self.no_song_detected_count > 3:  # Reset after 3 failed detections
                 if self.current_track:
                     self.current_track = None
-                    await self._notify_track_listeners()
+                    await self._broadcast_track()
                 self.no_song_detected_count = 0
                 
+    def _enqueue_audio(self, data: Optional[bytes]):
+        """Hand a captured chunk to the event loop, dropping the oldest if full."""
+        if self._audio_queue.full():
+            self._audio_queue.get_nowait()
+        self._audio_queue.put_nowait(data)
+
+    def _audio_callback(self, in_data, frame_count, time_info, status):
+        """PortAudio stream callback: pass each captured chunk to the loop."""
+        self._loop.call_soon_threadsafe(self._enqueue_audio, in_data)
+        return None, pyaudio.paContinue
+
+    async def _record(self, seconds: float):
+        """Collect the given duration of captured audio into the audio buffer.
+
+        Chunks that arrived while the loop was busy count towards the
+        duration, so this only waits for whatever is still missing.
+
+        Returns:
+            np.ndarray: The most recent int16 samples
+        """
+        # Always wait for at least one new chunk so a stalled capture times out
+        needed = max(1, math.ceil(RATE * seconds / CHUNK))
+        received = 0
+        while received < needed or not self._audio_queue.empty():
+            try:
+                data = await asyncio.wait_for(self._audio_queue.get(), AUDIO_READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise IOError("Audio capture stopped") from None
+            self._audio_buffer.write(data)
+            received += 1
+        self._fresh_chunks += received
+        return self._audio_buffer.tail(seconds)
+
     async def _run_vinylpi(self):
         """Main VinylPi loop."""
         try:
+            # PortAudio delivers chunks from its own thread through the
+            # callback, so capturing never blocks the loop
+            self._loop = asyncio.get_running_loop()
+            self._audio_queue = asyncio.Queue(maxsize=AUDIO_QUEUE_SIZE)
+
             # Initialize PyAudio
             self.pyaudio = pyaudio.PyAudio()
             self.stream = self.pyaudio.open(
@@ -194,34 +418,50 @@ class VinylPiManager:
                 rate=RATE,
                 input=True,
                 input_device_index=self.current_device,
-                frames_per_buffer=CHUNK
+                frames_per_buffer=CHUNK,
+                stream_callback=self._audio_callback
             )
             
-            async def recognize_func(audio_data):
-                return await recognize_song(audio_data, False, self.logger)
-            
+            self._song_tally.clear()
             while self.running:
                 try:
-                    # Check audio level
-                    audio_level = get_audio_level(self.stream, 0.1)  # 100ms check
+                    # Check audio level, sampling less while a track is playing
+                    level_window = LEVEL_WINDOW_PLAYING if self.current_track else LEVEL_WINDOW_IDLE
+                    audio_level = get_audio_level(await self._record(level_window))
                     self.debug_info['audio_level'] = audio_level
                     self.logger.debug(f"Audio level: {audio_level}")
-                    await self._notify_status_listeners()
+                    await self._broadcast_audio_level(audio_level)
+                    await self._broadcast_status()
                     
                     if audio_level < 5:  # Silence threshold (5% of max volume)
                         self.logger.debug("Audio level below threshold, skipping detection")
+                        self._stable_ticks = 0
+                        self._fresh_chunks = 0
+                        self._song_tally.clear()
                         await asyncio.sleep(0.5)  # Check every 500ms
                         continue
                         
-                    # Normal song detection flow
+                    # Only recognize once a full window of new audio has been
+                    # captured; until then the tick just updates the level
+                    if self._fresh_chunks < RECOGNIZE_CHUNKS:
+                        await asyncio.sleep(CHECK_INTERVAL)
+                        continue
+
+                    # Recognize the latest window; the level read above has
+                    # just drained everything captured since the last tick.
+                    # Copy it out since the ring buffer keeps being written.
+                    self._fresh_chunks = 0
                     self.logger.info("Starting song detection...")
-                    self.debug_info['last_detection_time'] = datetime.now().isoformat()
+                    self.debug_info['last_detection_time_ts'] = time.time()
                     self.debug_info['detection_count'] += 1
-                    song = await check_song_consistency(recognize_func, self.stream, False, self.logger)
+                    window = bytes(self._audio_buffer.tail(RECORD_SECONDS))
+                    song = self._song_tally.add(*await recognize_song(window, False, self.logger))
                     self.logger.info(f"Song detection result: {song}")
                     await self._process_song_detection(song)
                     
-                    await asyncio.sleep(CHECK_INTERVAL)
+                    # Back off while the same song keeps being detected
+                    interval = CHECK_INTERVAL * min(MAX_INTERVAL_FACTOR, 1 + self._stable_ticks)
+                    await asyncio.sleep(interval)
                     
                 except Exception as e:
                     self.logger.error(f"Error in VinylPi loop: {e}")
@@ -230,7 +470,7 @@ class VinylPiManager:
         except Exception as e:
             self.logger.error(f"Fatal error in VinylPi: {e}")
             self.running = False
-            await self._notify_status_listeners()
+            await self._broadcast_status()
         finally:
             if self.stream:
                 self.stream.stop_stream()
@@ -247,8 +487,19 @@ class VinylPiManager:
         self.logger.info(f"Starting VinylPi with device index {device_index}")
         self.current_device = device_index
         self.running = True
+        # Pick up Last.fm settings saved since the last start; this is
+        # free unless the credentials changed
+        try:
+            self.lastfm_network = await asyncio.get_running_loop().run_in_executor(
+                None, get_lastfm_network
+            )
+        except Exception as e:
+            self.logger.error(f"Error initializing Last.fm: {e}")
+        if self._scrobble_task is None:
+            self._scrobble_q = asyncio.Queue(maxsize=SCROBBLE_QUEUE_SIZE)
+            self._scrobble_task = asyncio.create_task(self._scrobble_worker())
         self._task = asyncio.create_task(self._run_vinylpi())
-        await self._notify_status_listeners()
+        await self._broadcast_status()
         return True
         
     async def stop(self) -> bool:
@@ -262,8 +513,8 @@ class VinylPiManager:
             self._task = None
         
         self.current_track = None
-        await self._notify_track_listeners()
-        await self._notify_status_listeners()
+        await self._broadcast_track()
+        await self._broadcast_status()
         return True
         
 
@@ -6,20 +6,26 @@ It handles command-line arguments, audio device selection, and the main recordin
 
 import argparse
 import asyncio
+import hashlib
 import logging
 import os
 import shutil
+import signal
 import sys
+import time
+from collections import OrderedDict, deque
 from typing import Tuple
 
 import pyaudio
 
 from vinylpi_lib import (
-    CHUNK, FORMAT, CHANNELS, RATE, CHECK_INTERVAL, RECORD_SECONDS,
-    SILENCE_THRESHOLD, ACTIVITY_THRESHOLD, ACTIVITY_WINDOW, STANDBY_WINDOW,
-    get_usb_audio_device, get_lastfm_network, clear_console,
+    CHUNK, FORMAT, CHANNELS, RATE, CHECK_INTERVAL, RECORD_SECONDS, CONSISTENCY_CHECKS,
+    ACTIVITY_WINDOW, STANDBY_WINDOW, STANDBY_POLL,
+    get_usb_audio_device, get_lastfm_network, clear_console, enable_ansi_console,
     aggressive_song_check, check_song_consistency, recognize_song,
-    update_lastfm_status, list_audio_devices, is_audio_active
+    update_lastfm_status, log_song_to_lastfm, list_audio_devices, is_audio_active, analyze_window,
+    is_valid_song,
+    invalidate_terminal_size, AudioRingBuffer, ShazamSession
 )
 
 def create_parser():
@@ -52,10 +58,27 @@ args = create_parser().parse_args()
 # Store the original stdout
 original_stdout = sys.stdout
 
+# Number of recent recognition results kept, keyed by audio fingerprint
+RECOGNITION_CACHE_SIZE = 32
+
 # Redirect stderr to /dev/null if not in verbose mode
 if not args.verbose:
     sys.stderr = open(os.devnull, 'w')
 
+# Terminal width and the strings derived from it, rebuilt after a resize
+_TUI_CACHE = {"width": None, "checked": 0.0, "border": "", "header": "", "blank": ""}
+
+def _invalidate_tui_cache(*_):
+    _TUI_CACHE["width"] = None
+    invalidate_terminal_size()
+
+# Without SIGWINCH (Windows) resizes can't be observed, so the width is
+# re-queried at most this often there
+TUI_SIZE_RECHECK = 1.0
+_HAS_SIGWINCH = hasattr(signal, "SIGWINCH")
+if _HAS_SIGWINCH:
+    signal.signal(signal.SIGWINCH, _invalidate_tui_cache)
+
 def display_tui(current_song=None, is_listening=True, standby=False, status_text=None) -> None:
     """Display the current playback status in a TUI format.
 
@@ -63,36 +86,53 @@ def display_tui(current_song=None, is_listening=True, standby=False, status_text
         current_song: Optional tuple of (artist, title)
         is_listening: Whether the program is currently listening for audio
     """
-    clear_console()
-    terminal_width, _ = shutil.get_terminal_size()
-    
-    print("+" + "-" * (terminal_width - 2) + "+")
-    print("|" + " VinylPi ".center(terminal_width - 2) + "|")
-    print("+" + "-" * (terminal_width - 2) + "+")
-    
+    cache = _TUI_CACHE
+    now = time.monotonic()
+    if cache["width"] is None or (not _HAS_SIGWINCH and now - cache["checked"] >= TUI_SIZE_RECHECK):
+        cache["checked"] = now
+        terminal_width, _ = shutil.get_terminal_size()
+        if terminal_width != cache["width"]:
+            # Only wipe the screen when the layout changes; otherwise the
+            # new frame simply overwrites the old one in place
+            clear_console()
+            cache["border"] = "+" + "-" * (terminal_width - 2) + "+"
+            cache["header"] = "|" + " VinylPi ".center(terminal_width - 2) + "|"
+            cache["blank"] = "|".ljust(terminal_width - 1) + "|"
+            cache["width"] = terminal_width
+    terminal_width = cache["width"]
+    border = cache["border"]
+
+    def row(text):
+        return text.ljust(terminal_width - 1) + "|"
+
+    lines = [border, cache["header"], border]
     if current_song:
         artist, title = current_song
-        print(f"| Now Playing:".ljust(terminal_width - 1) + "|")
-        print(f"|   Title: {title}".ljust(terminal_width - 1) + "|")
-        print(f"|   Artist: {artist}".ljust(terminal_width - 1) + "|")
+        lines += [row("| Now Playing:"), row(f"|   Title: {title}"), row(f"|   Artist: {artist}")]
     else:
-        print("|".ljust(terminal_width - 1) + "|")
-        print("| No track currently playing".ljust(terminal_width - 1) + "|")
-        print("|".ljust(terminal_width - 1) + "|")
-    
-    print("+" + "-" * (terminal_width - 2) + "+")
+        lines += [cache["blank"], row("| No track currently playing"), cache["blank"]]
+    lines.append(border)
     if is_listening:
         if status_text:
-            print(f"| {status_text}".ljust(terminal_width - 1) + "|")
+            lines.append(row(f"| {status_text}"))
         elif standby:
-            print("| Standby mode - Waiting for audio...".ljust(terminal_width - 1) + "|")
+            lines.append(row("| Standby mode - Waiting for audio..."))
         else:
-            print("| Listening for new tracks...".ljust(terminal_width - 1) + "|")
-    print("+" + "-" * (terminal_width - 2) + "+")
+            lines.append(row("| Listening for new tracks..."))
+    lines.append(border)
 
-def display_sound_meter(audio_stream, max_amp=1.0, bar_width=20):
+    # One write for the whole frame: home the cursor, draw, then clear
+    # anything left below it from a previous, longer frame
+    if enable_ansi_console():
+        sys.stdout.write("\x1b[H" + "\n".join(lines) + "\n\x1b[J")
+    else:
+        clear_console()
+        sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
+
+async def display_sound_meter(audio_buffer, max_amp=1.0, bar_width=20):
     while True:
-        data = audio_stream.read(CHUNK, exception_on_overflow=False)
+        data = await audio_buffer.read(CHUNK / RATE)
         amp = is_audio_active(data)
         amp = max(0.0, min(amp, max_amp))
         level = int((amp / max_amp) * (bar_width - 1)) + 1
@@ -109,44 +149,44 @@ async def main() -> None:
         list_audio_devices()
         sys.exit(0)
 
+    # One PortAudio session for device probing and capture; each PyAudio()
+    # re-enumerates every host API and device
+    p = pyaudio.PyAudio()
+
     if args.device is not None:
         selected_device = args.device
         if args.verbose:
             print(f"Using user-specified audio device index: {selected_device}", file=original_stdout)
     else:
         # Try to find a suitable audio device
-        p = pyaudio.PyAudio()
-        try:
-            # First try sysdefault
-            for i in range(p.get_device_count()):
-                devinfo = p.get_device_info_by_index(i)
-                if devinfo['maxInputChannels'] > 0 and 'sysdefault' in devinfo['name'].lower():
-                    selected_device = i
-                    if args.verbose:
-                        print(f"Using sysdefault audio device: {devinfo['name']} with {devinfo['maxInputChannels']} channels", file=original_stdout)
-                    break
-            else:
-                # If sysdefault not found, try USB or any input device
-                selected_device, max_channels = get_usb_audio_device()
-                if selected_device is None:
-                    print("No suitable audio device found. Available devices:", file=original_stdout)
-                    list_audio_devices()
-                    sys.exit(1)
+        # First try sysdefault
+        for i in range(p.get_device_count()):
+            devinfo = p.get_device_info_by_index(i)
+            if devinfo['maxInputChannels'] > 0 and 'sysdefault' in devinfo['name'].lower():
+                selected_device = i
                 if args.verbose:
-                    print(f"Using USB audio device with {max_channels} channels", file=original_stdout)
-        finally:
-            p.terminate()
+                    print(f"Using sysdefault audio device: {devinfo['name']} with {devinfo['maxInputChannels']} channels", file=original_stdout)
+                break
+        else:
+            # If sysdefault not found, try USB or any input device
+            selected_device, max_channels = get_usb_audio_device(p)
+            if selected_device is None:
+                print("No suitable audio device found. Available devices:", file=original_stdout)
+                list_audio_devices(p)
+                p.terminate()
+                sys.exit(1)
+            if args.verbose:
+                print(f"Using USB audio device with {max_channels} channels", file=original_stdout)
         
         if args.verbose:
-            p = pyaudio.PyAudio()
-            try:
-                devinfo = p.get_device_info_by_index(selected_device)
-                print(f"Using audio device: {devinfo['name']} (index: {selected_device})", file=original_stdout)
-                print(f"Device info: channels={devinfo['maxInputChannels']}, rate={devinfo['defaultSampleRate']}", file=original_stdout)
-            finally:
-                p.terminate()
-
-    p = pyaudio.PyAudio()
+            devinfo = p.get_device_info_by_index(selected_device)
+            print(f"Using audio device: {devinfo['name']} (index: {selected_device})", file=original_stdout)
+            print(f"Device info: channels={devinfo['maxInputChannels']}, rate={devinfo['defaultSampleRate']}", file=original_stdout)
+
+    # PortAudio fills the ring from its own thread; the loop below only waits
+    # for complete windows
+    loop = asyncio.get_running_loop()
+    audio_buffer = AudioRingBuffer(RECORD_SECONDS * 2, loop)
     
     def create_stream():
         return p.open(
@@ -156,13 +196,17 @@ async def main() -> None:
             input=True,
             input_device_index=selected_device,
             frames_per_buffer=CHUNK,
-            stream_callback=None  # Ensure blocking mode
+            stream_callback=audio_buffer.callback
         )
     
     stream = create_stream()
 
     if args.meter:
-        display_sound_meter(stream)
+        try:
+            await display_sound_meter(audio_buffer)
+        finally:
+            stream.close()
+            p.terminate()
         return
 
     lastfm_network = get_lastfm_network()
@@ -178,239 +222,200 @@ async def main() -> None:
     activity_count = 0
     no_song_detected_count = 0
 
-    while True:
-        try:
-            # Record and analyze audio data for activity detection
-            frames = []
-            max_amplitude = 0
-            stream_error = False
-            
-            # Flush the stream buffer to get fresh audio
-            stream.stop_stream()
-            stream.start_stream()
-            
-            for _ in range(int(RATE / CHUNK * RECORD_SECONDS)):
-                try:
-                    data = stream.read(CHUNK, exception_on_overflow=False)
-                    frames.append(data)
-                    # Check audio level of this chunk
-                    chunk_amplitude = is_audio_active(data)
-                    max_amplitude = max(max_amplitude, chunk_amplitude)
-                except IOError as e:
-                    if "Stream closed" in str(e):
-                        print("Stream closed, reopening...", file=original_stdout)
-                        try:
-                            stream.close()
-                        except:
-                            pass
-                        stream = create_stream()
-                        stream_error = True
-                        break
-                    else:
-                        print(f"IO Error reading from audio stream: {e}", file=original_stdout)
-                except Exception as e:
-                    print(f"Error reading from audio stream: {e}", file=original_stdout)
-                    continue
-            
-            # If we had a stream error, skip this iteration
-            if stream_error:
-                await asyncio.sleep(1)  # Brief pause before retry
-                continue
-
-            audio_data = b''.join(frames)
-
-            # Update standby state based on audio levels
-            if max_amplitude < SILENCE_THRESHOLD:
-                silence_count += 1
-                activity_count = 0
-                if silence_count >= STANDBY_WINDOW and not in_standby:
-                    in_standby = True
-                    if args.verbose:
-                        print("Entering standby mode - no audio detected", file=original_stdout)
-            elif max_amplitude > ACTIVITY_THRESHOLD:
-                activity_count += 1
-                silence_count = 0
-                if activity_count >= ACTIVITY_WINDOW and in_standby:
-                    in_standby = False
-                    if args.verbose:
-                        print("Exiting standby mode - audio activity detected", file=original_stdout)
-
-            # Update display with audio levels
-            if args.tui:
-                status = "Standby" if in_standby else "Active"
-                level = f"Audio: {max_amplitude:.3f}"
-                display_tui(current_song, standby=in_standby, status_text=f"{status} - {level}")
-            elif args.verbose:
-                print(f"Audio level: {max_amplitude:.3f} ({'Standby' if in_standby else 'Active'})", file=original_stdout, flush=True)
-                if not in_standby:
-                    print("Starting song detection...", file=original_stdout, flush=True)
-
-            # Skip song recognition if in standby mode
-            if in_standby:
-                await asyncio.sleep(CHECK_INTERVAL)
-                continue
+    # Loop invariants, bound once instead of looked up on every iteration
+    verbose = args.verbose
+    tui = args.tui
+    read_window = audio_buffer.read
+
+    recognition_cache = OrderedDict()
+    # One HTTP session for every Shazam request this run
+    http_client = ShazamSession()
+
+    async def recognize_func(audio_data):
+        # Identical windows (e.g. the repeated consistency checks on one
+        # capture) are answered from the cache instead of asking Shazam again.
+        # The cache holds the recognition task itself, so a window that is
+        # still being recognized is not sent a second time either.
+        key = hashlib.blake2b(audio_data, digest_size=16).digest()
+        task = recognition_cache.get(key)
+        if task is None or task.cancelled():
+            task = asyncio.ensure_future(
+                recognize_song(audio_data, verbose, original_stdout, http_client)
+            )
+            recognition_cache[key] = task
+            if len(recognition_cache) > RECOGNITION_CACHE_SIZE:
+                recognition_cache.popitem(last=False)
+        else:
+            recognition_cache.move_to_end(key)
+        # Shielded so a caller giving up doesn't cancel it for the others
+        return await asyncio.shield(task)
 
-            async def recognize_func(audio_data):
-                return await recognize_song(audio_data, args.verbose, original_stdout)
+    next_window = None
+    # Last few captured windows, checked together for a consistent match
+    recent_windows = deque(maxlen=CONSISTENCY_CHECKS)
 
-            # Record and analyze audio data for activity detection
-            frames = []
-            max_amplitude = 0
-            stream_error = False
-            
-            for _ in range(int(RATE / CHUNK * RECORD_SECONDS)):
+    try:
+        while True:
+            try:
+                # Record and analyze audio data for activity detection. In standby
+                # a single chunk is enough to notice the record starting again.
                 try:
-                    data = stream.read(CHUNK, exception_on_overflow=False)
-                    frames.append(data)
-                    # Check audio level of this chunk
-                    chunk_amplitude = is_audio_active(data)
-                    max_amplitude = max(max_amplitude, chunk_amplitude)
-                except IOError as e:
-                    if "Stream closed" in str(e):
-                        print("Stream closed, reopening...", file=original_stdout)
-                        try:
-                            stream.close()
-                        except:
-                            pass
-                        stream = create_stream()
-                        stream_error = True
-                        break
+                    if next_window is not None:
+                        window_task, next_window = next_window, None
+                        audio_data = await window_task
                     else:
-                        print(f"IO Error reading from audio stream: {e}", file=original_stdout)
-                except Exception as e:
-                    print(f"Error reading from audio stream: {e}", file=original_stdout)
+                        audio_data = await read_window(CHUNK / RATE if in_standby else RECORD_SECONDS)
+                except IOError as e:
+                    print(f"{e}, reopening...", file=original_stdout)
+                    try:
+                        stream.close()
+                    except:
+                        pass
+                    stream = create_stream()
+                    await asyncio.sleep(1)  # Brief pause before retry
                     continue
+                # The exact level is only needed for display
+                max_amplitude, is_silent, is_loud = analyze_window(audio_data, tui or verbose)
+
+                # Update standby state based on audio levels
+                if is_silent:
+                    silence_count += 1
+                    activity_count = 0
+                    if silence_count >= STANDBY_WINDOW and not in_standby:
+                        in_standby = True
+                        recent_windows.clear()
+                        if verbose:
+                            print("Entering standby mode - no audio detected", file=original_stdout)
+                elif is_loud:
+                    activity_count += 1
+                    silence_count = 0
+                    if activity_count >= ACTIVITY_WINDOW and in_standby:
+                        in_standby = False
+                        if verbose:
+                            print("Exiting standby mode - audio activity detected", file=original_stdout)
+
+                # Update display with audio levels
+                if tui:
+                    status = "Standby" if in_standby else "Active"
+                    level = f"Audio: {max_amplitude:.3f}"
+                    display_tui(current_song, standby=in_standby, status_text=f"{status} - {level}")
+                elif verbose:
+                    print(f"Audio level: {max_amplitude:.3f} ({'Standby' if in_standby else 'Active'})", file=original_stdout, flush=True)
+                    if not in_standby:
+                        print("Starting song detection...", file=original_stdout, flush=True)
+
+                # Skip song recognition if in standby mode
+                if in_standby:
+                    await asyncio.sleep(STANDBY_POLL)
+                    continue
+
+                # Process the recorded audio for song recognition
+                async def recognize_with_data(window):
+                    # Only try to recognize if we have valid audio data
+                    if not window.size:
+                        return None, None, 0
+                    # Force new song detection if we have full volume audio but no song
+                    if no_song_detected_count >= 3 and is_loud:
+                        if verbose:
+                            print("Full volume audio detected but no song found, forcing new detection...", file=original_stdout)
+                    return await recognize_func(window)
             
-            # If we had a stream error, skip this iteration
-            if stream_error:
-                await asyncio.sleep(1)  # Brief pause before retry
-                continue
-
-            audio_data = b''.join(frames)
-
-            # Update standby state based on audio levels
-            if max_amplitude < SILENCE_THRESHOLD:
-                silence_count += 1
-                activity_count = 0
-                if silence_count >= STANDBY_WINDOW and not in_standby:
-                    in_standby = True
-                    if args.verbose:
-                        print("Entering standby mode - no audio detected", file=original_stdout)
-            elif max_amplitude > ACTIVITY_THRESHOLD:
-                activity_count += 1
-                silence_count = 0
-                if activity_count >= ACTIVITY_WINDOW and in_standby:
-                    in_standby = False
-                    if args.verbose:
-                        print("Exiting standby mode - audio activity detected", file=original_stdout)
-
-            # Update display with audio levels
-            if args.tui:
-                status = "Standby" if in_standby else "Active"
-                level = f"Audio: {max_amplitude:.3f}"
-                display_tui(current_song, standby=in_standby, status_text=f"{status} - {level}")
-            elif args.verbose:
-                print(f"Audio level: {max_amplitude:.3f} ({'Standby' if in_standby else 'Active'})", file=original_stdout, flush=True)
-                if not in_standby:
-                    print("Starting song detection...", file=original_stdout, flush=True)
-
-            # Skip song recognition if in standby mode
-            if in_standby:
-                await asyncio.sleep(CHECK_INTERVAL)
-                continue
-
-            # Process the recorded audio for song recognition
-            async def recognize_with_data(audio_stream):
-                # Only try to recognize if we have valid audio data
-                if not frames:
-                    return None, None, 0
-                # Force new song detection if we have full volume audio but no song
-                if no_song_detected_count >= 3 and max_amplitude >= 0.99:
-                    if args.verbose:
-                        print("Full volume audio detected but no song found, forcing new detection...", file=original_stdout)
-                    return await recognize_func(audio_data)
-                return await recognize_func(audio_data)
-            
-            # Pass None as the audio stream since we already have the data
-            song = await check_song_consistency(recognize_with_data, None, args.verbose, original_stdout)
-
-            if song and song[0] and song[1] and song[0] != "None" and song[1] != "None":
-                artist, title = song
-                if song != current_song:
-                    consecutive_same_song_count = 1
-                    if args.tui:
-                        display_tui(song)
-                    elif not args.verbose:
-                        print(f"Now playing: {title} by {artist}", file=original_stdout, flush=True)
-                    artist, title, new_start_time = update_lastfm_status(
-                        lastfm_network, artist, title,
-                        last_logged_song, original_stdout,
-                        song_start_time
-                    )
-                    if artist and title:
-                        current_song = (artist, title)
-                        last_logged_song = current_song
-                        song_start_time = new_start_time
-                        no_song_detected_count = 0
-                else:
-                    consecutive_same_song_count += 1
-                    if args.verbose and not args.tui:
-                        print(f"Still playing: {title} by {artist}", file=original_stdout, flush=True)
-            else:
-                consecutive_same_song_count = 0
-                no_song_detected_count += 1
-                
-                # Clear now playing status if we've lost the song for a while
-                # But only if audio level is low - keep trying if we have audio
-                if no_song_detected_count >= 3 and max_amplitude < ACTIVITY_THRESHOLD:
-                    # If we had a song playing, scrobble it before clearing
-                    if current_song:
-                        _, _, _ = update_lastfm_status(
-                            lastfm_network, None, None,
-                            last_logged_song, original_stdout,
-                            song_start_time
-                        )
-                        current_song = None
-                        last_logged_song = None
-                        song_start_time = None
-                    
-                    # Try aggressive detection
-                    if args.verbose and not args.tui:
-                        print("No song detected. Trying aggressive detection...", file=original_stdout, flush=True)
-
-                    # Create a function that will use our pre-recorded audio data
-                    async def recognize_func_aggressive(audio_data):
-                        return await recognize_song(audio_data, args.verbose, original_stdout)
-
-                    # Pass None as the audio stream since we already have the data
-                    song = await aggressive_song_check(recognize_func_aggressive, None, args.verbose, original_stdout)
-                    if song and song[0] and song[1] and song[0] != "None" and song[1] != "None":
-                        artist, title = song
-                        if args.tui:
+                # Start capturing the next window now so it fills while this
+                # one is being recognized
+                next_window = asyncio.create_task(read_window(RECORD_SECONDS))
+
+                # Check consistency over the windows already captured; earlier
+                # ones are answered from the recognition cache
+                recent_windows.append(audio_data)
+                song = await check_song_consistency(
+                    recognize_with_data, None, verbose, original_stdout,
+                    audio_source=recent_windows
+                )
+
+                if is_valid_song(song):
+                    artist, title = song
+                    if song != current_song:
+                        consecutive_same_song_count = 1
+                        if tui:
                             display_tui(song)
-                        elif not args.verbose:
-                            print(f"Detected after aggressive check: {title} by {artist}", file=original_stdout, flush=True)
-                        last_logged_song = log_song_to_lastfm(
+                        elif not verbose:
+                            print(f"Now playing: {title} by {artist}", file=original_stdout, flush=True)
+                        artist, title, new_start_time = await loop.run_in_executor(
+                            None, update_lastfm_status,
                             lastfm_network, artist, title,
-                            last_logged_song, original_stdout
+                            last_logged_song, original_stdout,
+                            song_start_time
                         )
-                        current_song = song
-                        no_song_detected_count = 0
+                        if artist and title:
+                            current_song = (artist, title)
+                            last_logged_song = current_song
+                            song_start_time = new_start_time
+                            no_song_detected_count = 0
                     else:
-                        if args.tui:
-                            display_tui()
-                        elif not args.verbose:
-                            print("No valid song detected", file=original_stdout, flush=True)
-                        current_song = None
+                        consecutive_same_song_count += 1
+                        if verbose and not tui:
+                            print(f"Still playing: {title} by {artist}", file=original_stdout, flush=True)
+                else:
+                    consecutive_same_song_count = 0
+                    no_song_detected_count += 1
+                
+                    # Clear now playing status if we've lost the song for a while
+                    # But only if audio level is low - keep trying if we have audio
+                    if no_song_detected_count >= 3 and not is_loud:
+                        # If we had a song playing, scrobble it before clearing
+                        if current_song:
+                            await loop.run_in_executor(
+                                None, update_lastfm_status,
+                                lastfm_network, None, None,
+                                last_logged_song, original_stdout,
+                                song_start_time
+                            )
+                            current_song = None
+                            last_logged_song = None
+                            song_start_time = None
+                    
+                        # Try aggressive detection
+                        if verbose and not tui:
+                            print("No song detected. Trying aggressive detection...", file=original_stdout, flush=True)
+
+                        song = await aggressive_song_check(recognize_func, audio_buffer, verbose, original_stdout)
+                        if is_valid_song(song):
+                            artist, title = song
+                            if tui:
+                                display_tui(song)
+                            elif not verbose:
+                                print(f"Detected after aggressive check: {title} by {artist}", file=original_stdout, flush=True)
+                            last_logged_song = await loop.run_in_executor(
+                                None, log_song_to_lastfm,
+                                lastfm_network, artist, title,
+                                last_logged_song, original_stdout
+                            )
+                            current_song = song
+                            no_song_detected_count = 0
+                        else:
+                            if tui:
+                                display_tui()
+                            elif not verbose:
+                                print("No valid song detected", file=original_stdout, flush=True)
+                            current_song = None
             
-            await asyncio.sleep(CHECK_INTERVAL)
-
-        except Exception as e:
-            print(f"An error occurred: {e}", file=original_stdout, flush=True)
+                await asyncio.sleep(CHECK_INTERVAL)
 
-    stream.stop_stream()
-    stream.close()
-    p.terminate()
+            except Exception as e:
+                print(f"An error occurred: {e}", file=original_stdout, flush=True)
+    finally:
+        if next_window is not None:
+            next_window.cancel()
+        stream.stop_stream()
+        stream.close()
+        p.terminate()
+        await http_client.close()
 
 if __name__ == "__main__":
+    # uvloop is optional; fall back to the stdlib event loop without it
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main())
\ No newline at end of file
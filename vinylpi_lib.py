@@ -9,21 +9,49 @@ This module provides the core functionality for the VinylPi application, includi
 
 import asyncio
 import collections
-import io
+import ctypes
+import functools
 import json
 import os
 import shutil
+import struct
+import sys
+import threading
 import time
-import wave
+from concurrent.futures import ThreadPoolExecutor
 
+import aiohttp
+import numpy as np
 import pyaudio
 import pylast
+from aiohttp_retry import ExponentialRetry, RetryClient
 from shazamio import Shazam
+from shazamio.interfaces.client import HTTPClientInterface
+
+# numpy-minmax is optional; it finds both extremes in one SIMD pass
+try:
+    import numpy_minmax
+except ImportError:
+    numpy_minmax = None
+
+# orjson is optional too; it parses Shazam's large responses much faster.
+# Both helpers work on UTF-8 bytes whichever library is used.
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
 
 CHUNK = 8192  # Larger chunks for better quality
-FORMAT = pyaudio.paFloat32
+FORMAT = pyaudio.paInt16  # Shazam wants 16-bit PCM, so capture it natively
+SAMPLE_SCALE = 32768.0  # int16 full scale; levels are reported as 0..1
 CHANNELS = 1
 RATE = 44100  # Standard CD quality
+SHAZAM_RATE = 16000  # Shazam fingerprints 16 kHz mono audio
 
 RECORD_SECONDS = 8  # Longer sample for better recognition
 CHECK_INTERVAL = 3
@@ -34,12 +62,21 @@ CONSISTENCY_CHECKS = 3  # Number of checks
 CONSISTENCY_THRESHOLD = 2  # Need at least 2 matches
 CONFIDENCE_THRESHOLD = 0  # Ignore confidence since Shazam sometimes returns 0 for valid matches
 CHECK_DELAY = 1  # Delay between checks
+SHAZAM_CONCURRENCY = 3  # Recognition requests allowed in flight at once
+MAX_SHAZAM_RETRY_DELAY = 30  # Upper bound in seconds on honoring Shazam's retryms hint
+
+# Worker threads for the NumPy resampling and WAV encoding done before each
+# recognition; NumPy releases the GIL, so this runs beside the event loop
+_ENCODE_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="vinylpi-encode")
+_ENCODE_SCRATCH = threading.local()
 
 # Audio level detection settings
 SILENCE_THRESHOLD = 0.95  # Audio levels below this are considered silence/noise
 ACTIVITY_THRESHOLD = 0.99  # Audio levels above this indicate active playback
 ACTIVITY_WINDOW = 2  # Number of consecutive chunks above threshold to exit standby
 STANDBY_WINDOW = 20  # Number of consecutive chunks below threshold to enter standby (about 1 minute)
+MIN_RECOGNITION_LEVEL = 0.05  # Windows quieter than this are not sent to Shazam
+STANDBY_POLL = 0.5  # Seconds between single-chunk level checks while in standby
 
 def is_audio_active(audio_data):
     """Check if there is significant audio activity in the data.
@@ -48,11 +85,142 @@ def is_audio_active(audio_data):
         audio_data: Raw audio data to analyze
 
     Returns:
-        float: Maximum amplitude of the audio data
+        float: Maximum amplitude of the audio data, from 0 to 1
+    """
+    audio_array = np.frombuffer(audio_data, dtype=np.int16)
+    if not audio_array.size:
+        return 0.0
+    # Peak magnitude from the extremes, without allocating an abs() copy
+    if numpy_minmax is not None:
+        low, high = numpy_minmax.minmax(audio_array)
+    else:
+        low, high = audio_array.min(), audio_array.max()
+    return max(int(high), -int(low)) / SAMPLE_SCALE
+
+def any_above(audio_data, threshold):
+    """Check whether any sample's magnitude exceeds a threshold.
+
+    Cheaper than ``is_audio_active`` when only the threshold decision is
+    needed: the buffer is scanned a chunk at a time and the scan stops at
+    the first loud chunk.
+
+    Args:
+        audio_data: Raw audio data to analyze
+        threshold: Amplitude to compare against, from 0 to 1
+
+    Returns:
+        bool: True if some sample is louder than ``threshold``
+    """
+    audio_array = np.frombuffer(audio_data, dtype=np.int16)
+    threshold *= SAMPLE_SCALE
+    for start in range(0, audio_array.size, CHUNK):
+        block = audio_array[start:start + CHUNK]
+        if block.max() > threshold or block.min() < -threshold:
+            return True
+    return False
+
+def analyze_window(audio_data, need_level=True):
+    """Classify a captured window against the standby thresholds.
+
+    Args:
+        audio_data: Raw audio data to analyze
+        need_level: Whether the exact peak level is wanted (e.g. for
+            display). Without it the thresholds are checked with an
+            early-exit scan instead of a full reduction.
+
+    Returns:
+        tuple: (level, is_silent, is_loud), with level None if not requested
     """
-    import numpy as np
-    audio_array = np.frombuffer(audio_data, dtype=np.float32)
-    return np.max(np.abs(audio_array))
+    if need_level:
+        level = is_audio_active(audio_data)
+        return level, level < SILENCE_THRESHOLD, level > ACTIVITY_THRESHOLD
+    is_silent = not any_above(audio_data, SILENCE_THRESHOLD)
+    return None, is_silent, not is_silent and any_above(audio_data, ACTIVITY_THRESHOLD)
+
+class AudioRingBuffer:
+    """Fixed-size ring of the most recent int16 samples, fed by PortAudio.
+
+    Pass ``callback`` as the ``stream_callback`` of a PyAudio stream. It runs
+    on PortAudio's own thread and only copies the new samples in, so capture
+    never waits on the event loop. Coroutines call ``read`` to wait for a
+    fresh window of audio.
+    """
+
+    def __init__(self, seconds, loop):
+        """Create a ring holding ``seconds`` of audio.
+
+        Args:
+            seconds: Capacity of the ring in seconds
+            loop: Event loop that waits on the ring
+        """
+        self._buf = np.zeros(int(RATE * seconds), dtype=np.int16)
+        self._pos = 0
+        self._written = 0
+        self._lock = threading.Lock()
+        self._loop = loop
+        self._ready = asyncio.Event()
+
+    def callback(self, in_data, frame_count, time_info, status):
+        """PortAudio stream callback appending captured audio to the ring."""
+        samples = np.frombuffer(in_data, dtype=np.int16)[-len(self._buf):]
+        n = len(samples)
+        with self._lock:
+            end = self._pos + n
+            if end <= len(self._buf):
+                self._buf[self._pos:end] = samples
+            else:
+                split = len(self._buf) - self._pos
+                self._buf[self._pos:] = samples[:split]
+                self._buf[:n - split] = samples[split:]
+            self._pos = end % len(self._buf)
+            self._written += n
+        self._loop.call_soon_threadsafe(self._ready.set)
+        return None, pyaudio.paContinue
+
+    def tail(self, seconds):
+        """Return a copy of the most recent audio.
+
+        The window is copied straight into one newly allocated array, even
+        when it wraps around the end of the ring.
+
+        Args:
+            seconds: Length of the window in seconds
+
+        Returns:
+            numpy.ndarray: Up to ``seconds`` of the newest int16 samples
+        """
+        with self._lock:
+            n = min(int(RATE * seconds), self._written, len(self._buf))
+            start = self._pos - n
+            if start >= 0:
+                return self._buf[start:self._pos].copy()
+            out = np.empty(n, dtype=np.int16)
+            out[:-start] = self._buf[start:]
+            out[-start:] = self._buf[:self._pos]
+            return out
+
+    async def read(self, seconds, timeout=2.0):
+        """Wait until ``seconds`` of new audio have been captured and return it.
+
+        Args:
+            seconds: Length of the window in seconds
+            timeout: How long to wait for the stream to deliver data before
+                giving up
+
+        Returns:
+            numpy.ndarray: The freshly captured window as int16 samples
+
+        Raises:
+            IOError: If the stream stops delivering audio
+        """
+        target = self._written + int(RATE * seconds)
+        while self._written < target:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), seconds + timeout)
+            except asyncio.TimeoutError:
+                raise IOError("Stream closed: no audio received") from None
+        return self.tail(seconds)
 
 def store_user_info():
     """Store Last.fm user credentials in a JSON file.
@@ -74,62 +242,106 @@ def store_user_info():
             "password_hash": password_hash
         }
 
-        with open(USER_INFO_FILE, "w", encoding='utf-8') as f:
-            json.dump(user_info, f)
+        with open(USER_INFO_FILE, "wb") as f:
+            f.write(_json_dumps(user_info))
+        load_user_info.cache_clear()
         return user_info
     return load_user_info()
 
+@functools.lru_cache(maxsize=1)
 def load_user_info():
     """Load Last.fm user credentials from JSON file.
 
+    The parsed file is cached; store_user_info clears the cache whenever
+    it writes new credentials.
+
     Returns:
         dict: User information including API keys and credentials
     """
-    if os.path.exists(USER_INFO_FILE):
-        with open(USER_INFO_FILE, "r", encoding='utf-8') as f:
-            return json.load(f)
-    return store_user_info()
+    try:
+        with open(USER_INFO_FILE, "rb") as f:
+            return _json_loads(f.read())
+    except FileNotFoundError:
+        return store_user_info()
 
-def list_audio_devices():
+def list_audio_devices(p=None):
     """List all available audio input devices.
 
     Prints information about each audio device that has at least one input channel.
+
+    Args:
+        p: Optional PyAudio instance to reuse; a temporary one is created otherwise
     """
 
-    p = pyaudio.PyAudio()
+    owned = p is None
+    if owned:
+        p = pyaudio.PyAudio()
     device_count = p.get_device_count()
     for i in range(device_count):
         device_info = p.get_device_info_by_index(i)
         if device_info["maxInputChannels"] > 0:
             device_name = device_info["name"]
             print(f"Device Index {i}: {device_name}")
-    p.terminate()
+    if owned:
+        p.terminate()
 
-def get_usb_audio_device():
+def get_usb_audio_device(p=None):
     """Find the first available USB audio device.
 
+    Args:
+        p: Optional PyAudio instance to reuse; a temporary one is created otherwise
+
     Returns:
         tuple: (device_index, max_channels) or (None, None) if not found
     """
-    p = pyaudio.PyAudio()
+    owned = p is None
+    if owned:
+        p = pyaudio.PyAudio()
+    first_input = None
     try:
-        # First try to find a device with 'USB' in the name
-        for i in range(p.get_device_count()):
-            devinfo = p.get_device_info_by_index(i)
-            if devinfo['maxInputChannels'] > 0:
-                name = devinfo['name'].lower()
-                if 'usb' in name:
-                    return i, devinfo['maxInputChannels']
-        
-        # If no USB device found, return the first device with input channels
+        # The default input is usually the USB interface already (e.g. a
+        # Pi whose only input is a USB ADC), which saves enumerating
+        try:
+            devinfo = p.get_default_input_device_info()
+            if devinfo['maxInputChannels'] > 0 and 'usb' in devinfo['name'].lower():
+                return devinfo['index'], devinfo['maxInputChannels']
+        except IOError:
+            pass  # No default input device
+
+        # One pass, stopping at the first USB input; each lookup is a
+        # PortAudio call
         for i in range(p.get_device_count()):
             devinfo = p.get_device_info_by_index(i)
-            if devinfo['maxInputChannels'] > 0:
-                return i, devinfo['maxInputChannels']
+            channels = devinfo['maxInputChannels']
+            if channels <= 0:
+                continue
+            if 'usb' in devinfo['name'].lower():
+                return i, channels
+            if first_input is None:
+                # Fallback when there is no USB device: the first input
+                first_input = (i, channels)
     finally:
-        p.terminate()
+        if owned:
+            p.terminate()
+
+    if first_input:
+        return first_input
     return None, None
 
+# Values Shazam or the checks may report in place of a real artist/title
+_INVALID_SONG_FIELDS = frozenset((None, "None", ""))
+
+def is_valid_song(song):
+    """Check whether a recognition result names a real song.
+
+    Args:
+        song: Tuple starting with (artist, title), or None
+
+    Returns:
+        bool: True if both artist and title are present
+    """
+    return bool(song) and song[0] not in _INVALID_SONG_FIELDS and song[1] not in _INVALID_SONG_FIELDS
+
 def get_lastfm_network():
     """Initialize and return a Last.fm network connection.
 
@@ -158,7 +370,7 @@ def update_lastfm_status(network, artist, title, last_logged_song, original_stdo
     Returns:
         tuple: (artist, title, start_time) of the current song
     """
-    if not artist or not title or artist == "None" or title == "None":
+    if not is_valid_song((artist, title)):
         # Clear now playing if no valid song
         try:
             network.update_now_playing(artist="", title="")
@@ -191,13 +403,180 @@ def update_lastfm_status(network, artist, title, last_logged_song, original_stdo
     # Same song still playing
     return artist, title, start_time if start_time else current_time
 
-async def recognize_song(audio_data, verbose, original_stdout):
+def log_song_to_lastfm(network, artist, title, last_logged_song, original_stdout):
+    """Scrobble a song to Last.fm unless it was the last one logged.
+
+    Args:
+        network: Last.fm network connection
+        artist: Name of the artist
+        title: Title of the song
+        last_logged_song: Previously logged song to avoid duplicates
+        original_stdout: Original stdout for printing
+
+    Returns:
+        tuple: The logged (artist, title), or last_logged_song if nothing was logged
+    """
+    # Repeats of the last song are the common case; last_logged_song is
+    # always valid, so this check can come first
+    if (artist, title) == last_logged_song:
+        print(f"Duplicate song detected. Not logging: {title} by {artist}", file=original_stdout, flush=True)
+        return last_logged_song
+
+    if not is_valid_song((artist, title)):
+        print("Song not logged: Invalid artist or title", file=original_stdout, flush=True)
+        return last_logged_song
+
+    try:
+        network.scrobble(artist=artist, title=title, timestamp=int(time.time()))
+        print(f"Logged to Last.fm: {title} by {artist}", file=original_stdout, flush=True)
+        return artist, title
+    except Exception as e:
+        print(f"Error logging to Last.fm: {e}", file=original_stdout, flush=True)
+        return last_logged_song
+
+class ShazamSession(HTTPClientInterface):
+    """shazamio HTTP client that keeps one aiohttp session for all requests.
+
+    shazamio's default client opens a new session, and with it a new TLS
+    connection, for every recognition. Reusing the session keeps the
+    connection to Shazam alive between checks.
+    """
+
+    def __init__(self):
+        self._client = None
+
+    async def request(self, method, url, *args, **kwargs):
+        """Send a GET or POST request and decode the JSON response."""
+        if self._client is None:
+            session = aiohttp.ClientSession(
+                # One connection per request the semaphore lets through
+                connector=aiohttp.TCPConnector(
+                    limit=SHAZAM_CONCURRENCY, ttl_dns_cache=300, keepalive_timeout=60
+                )
+            )
+            self._client = RetryClient(
+                client_session=session,
+                retry_options=ExponentialRetry(
+                    attempts=12, max_timeout=60, statuses={500, 502, 503, 504, 429}
+                ),
+            )
+        content_type = args[0] if args else "application/json"
+        async with self._client.request(method.upper(), url, **kwargs) as resp:
+            return await resp.json(loads=_json_loads, content_type=content_type)
+
+    async def close(self):
+        """Close the underlying session."""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+# Earliest time (time.monotonic) Shazam asked to be retried after a miss
+_SHAZAM_RETRY = {"at": 0.0}
+
+def shazam_retry_delay():
+    """Return how long Shazam asked to wait before the next attempt.
+
+    Misses come back with a ``retryms`` hint; retrying sooner mostly burns
+    requests on the same answer.
+
+    Returns:
+        float: Seconds left until the suggested retry time, or 0
+    """
+    return max(0.0, _SHAZAM_RETRY["at"] - time.monotonic())
+
+# Shazam clients by HTTP client, so each is only constructed once
+_SHAZAM_INSTANCES = {}
+
+def _get_shazam(http_client=None):
+    """Return the shared Shazam instance for an HTTP client.
+
+    Args:
+        http_client: shazamio HTTP client, or None for shazamio's default
+
+    Returns:
+        Shazam: Instance reused across recognitions
+    """
+    shazam = _SHAZAM_INSTANCES.get(http_client)
+    if shazam is None:
+        shazam = _SHAZAM_INSTANCES[http_client] = Shazam(http_client=http_client)
+    return shazam
+
+def to_shazam_pcm(audio_array, out=None):
+    """Convert captured audio to 16 kHz mono int16 for fingerprinting.
+
+    Shazam resamples everything to 16 kHz mono before fingerprinting, so
+    doing it here shrinks the WAV that has to be encoded and decoded again.
+
+    Args:
+        audio_array: int16 samples at RATE, interleaved if CHANNELS > 1
+        out: Optional int16 array to write into; must be large enough for
+            the resampled window
+
+    Returns:
+        numpy.ndarray: int16 mono samples at SHAZAM_RATE (a view of ``out``
+        when one is given)
+    """
+    if CHANNELS > 1:
+        audio_array = audio_array.reshape(-1, CHANNELS).mean(axis=1)
+    step = RATE / SHAZAM_RATE
+    if step > 1:
+        # Box filter over one output period to limit aliasing, then
+        # pick samples on the target grid
+        width = int(np.ceil(step))
+        audio_array = np.convolve(audio_array, np.full(width, 1.0 / width, dtype=np.float32), mode='same')
+        positions = np.arange(0, len(audio_array) - 1, step)
+        audio_array = np.interp(positions, np.arange(len(audio_array)), audio_array)
+    if out is None:
+        return audio_array.astype(np.int16)
+    # Filtered and interpolated samples stay within the int16 range, so
+    # they can be narrowed straight into the output buffer
+    pcm = out[:len(audio_array)]
+    np.copyto(pcm, audio_array, casting='unsafe')
+    return pcm
+
+# RIFF/WAVE header for 16 kHz mono 16-bit PCM; only the sizes vary
+_WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+
+@functools.lru_cache(maxsize=8)
+def _wav_header(data_size):
+    """Build the 44-byte WAV header for ``data_size`` bytes of samples.
+
+    Windows are almost always the same length, so the packed header is
+    cached per size and each request only has to prepend it.
+    """
+    return _WAV_HEADER.pack(
+        b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16,
+        1, 1, SHAZAM_RATE, SHAZAM_RATE * 2, 2, 16,  # PCM, mono, 16-bit
+        b"data", data_size
+    )
+
+def encode_shazam_wav(audio_array):
+    """Encode captured audio as the WAV file sent to Shazam.
+
+    Args:
+        audio_array: int16 samples at RATE
+
+    Returns:
+        bytes: 16 kHz mono 16-bit WAV data
+    """
+    # Each encoding thread converts into its own reusable int16 buffer
+    scratch = getattr(_ENCODE_SCRATCH, "pcm", None)
+    needed = int(len(audio_array) / CHANNELS * SHAZAM_RATE / RATE) + 1
+    if scratch is None or len(scratch) < needed:
+        scratch = _ENCODE_SCRATCH.pcm = np.empty(needed, dtype=np.int16)
+    pcm = to_shazam_pcm(audio_array, out=scratch)
+    # Header and samples joined in one copy, without the wave module
+    return b"".join((_wav_header(pcm.nbytes), pcm))
+
+async def recognize_song(audio_data, verbose, original_stdout, http_client=None):
     """Recognize a song from audio data using Shazam.
 
     Args:
         audio_data: Raw audio data to analyze
         verbose: Whether to print verbose output
         original_stdout: Original stdout for printing
+        http_client: Optional shazamio HTTP client to send requests through,
+            such as a shared ShazamSession
 
     Returns:
         tuple: (artist, title, confidence) if song is recognized, (None, None, 0) otherwise
@@ -209,29 +588,23 @@ async def recognize_song(audio_data, verbose, original_stdout):
 
     try:
         # Debug: Check audio data
-        import numpy as np
-        audio_array = np.frombuffer(audio_data, dtype=np.float32)
-        max_amplitude = np.max(np.abs(audio_array))
+        audio_array = np.frombuffer(audio_data, dtype=np.int16)
         if verbose:
-            print(f"Audio max amplitude: {max_amplitude}", file=original_stdout, flush=True)
+            print(f"Audio max amplitude: {is_audio_active(audio_array)}", file=original_stdout, flush=True)
 
-        # Skip recognition if audio is too quiet
-        if max_amplitude < 0.05:  # Lowered threshold
+        # Skip recognition if audio is too quiet; only the yes/no answer is
+        # needed, so the scan stops at the first loud chunk
+        if not any_above(audio_array, MIN_RECOGNITION_LEVEL):
             if verbose:
                 print("Audio level too low for recognition", file=original_stdout, flush=True)
             return None, None, 0
 
-        shazam = Shazam()
-        # Convert audio to the format Shazam expects
-        with io.BytesIO() as wav_file:
-            with wave.open(wav_file, 'wb') as wav:
-                wav.setnchannels(CHANNELS)
-                wav.setsampwidth(2)  # Always use 16-bit for Shazam
-                wav.setframerate(RATE)
-                # Convert float32 to int16
-                audio_array = (audio_array * 32767).astype(np.int16)
-                wav.writeframes(audio_array.tobytes())
-            wav_data = wav_file.getvalue()
+        shazam = _get_shazam(http_client)
+        # Resampling and encoding run on the worker pool so capture and
+        # other recognitions keep going on the event loop
+        wav_data = await asyncio.get_running_loop().run_in_executor(
+            _ENCODE_POOL, encode_shazam_wav, audio_array
+        )
         
         result = await shazam.recognize(wav_data)
         if result and 'track' in result:
@@ -241,81 +614,198 @@ async def recognize_song(audio_data, verbose, original_stdout):
                 print(f"Detected: {result['track']['subtitle']} - {result['track']['title']}",
                       file=original_stdout, flush=True)
             return result['track']['subtitle'], result['track']['title'], confidence
+        retry_ms = result.get('retryms') if result else None
+        if retry_ms:
+            delay = min(retry_ms / 1000, MAX_SHAZAM_RETRY_DELAY)
+            _SHAZAM_RETRY["at"] = time.monotonic() + delay
+            if verbose:
+                print(f"No match; Shazam suggests retrying in {delay:.1f}s", file=original_stdout, flush=True)
     except Exception as e:
         if verbose:
             print(f"Error in song recognition: {e}", file=original_stdout, flush=True)
     
     return None, None, 0
 
-def clear_console():
-    """Clear the console screen using the appropriate system command."""
+# Whether the console interprets ANSI escapes; None until first checked
+_ANSI_ENABLED = None
+
+def enable_ansi_console():
+    """Make sure the console interprets ANSI escape sequences.
+
+    Unix terminals always do. Windows 10+ consoles need virtual terminal
+    processing switched on, which only has to happen once per process.
 
-    os.system('cls' if os.name == 'nt' else 'clear')
+    Returns:
+        bool: Whether ANSI escapes will be interpreted
+    """
+    global _ANSI_ENABLED
+    if _ANSI_ENABLED is not None:
+        return _ANSI_ENABLED
+    _ANSI_ENABLED = True
+    if os.name == 'nt':
+        try:
+            kernel32 = ctypes.windll.kernel32
+            handle = kernel32.GetStdHandle(-11)  # STD_OUTPUT_HANDLE
+            mode = ctypes.c_uint32()
+            _ANSI_ENABLED = bool(
+                kernel32.GetConsoleMode(handle, ctypes.byref(mode))
+                # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+                and kernel32.SetConsoleMode(handle, mode.value | 0x0004)
+            )
+        except (AttributeError, OSError):
+            _ANSI_ENABLED = False
+    return _ANSI_ENABLED
+
+def clear_console():
+    """Clear the console screen and move the cursor to the top left.
 
-async def check_song_consistency(recognize_song_func, audio_stream, verbose, original_stdout):
+    Writes the ANSI escape directly instead of spawning a shell to run
+    `clear`, which matters since the TUI redraws several times a minute.
+    Older Windows consoles without escape support still get `cls`.
+    """
+    if not enable_ansi_console():
+        os.system('cls')
+        return
+    sys.stdout.write("\x1b[H\x1b[2J")
+    sys.stdout.flush()
+
+async def check_song_consistency(recognize_song_func, audio_buffer, verbose, original_stdout,
+                                 audio_source=None):
     """Check if a song is consistently recognized across multiple samples.
 
+    Each window is handed to a recognition task as soon as it is available,
+    so the Shazam round trips overlap each other and any remaining
+    recording. At most SHAZAM_CONCURRENCY requests are in flight at once.
+
     Args:
         recognize_song_func: Function to recognize songs
-        audio_stream: Audio stream to read from
+        audio_buffer: AudioRingBuffer fed by a callback stream, or None
+            when audio_source supplies the windows
         verbose: Whether to print verbose output
         original_stdout: Original stdout for printing
+        audio_source: Optional iterable of already captured windows. When
+            given, each window is checked once and nothing is recorded.
 
     Returns:
         tuple: Most consistent (artist, title) pair or (None, None)
     """
-
-    import collections
-    song_checks = []
-    confidence_scores = []
-
-    for i in range(CONSISTENCY_CHECKS):
-        if verbose:
-            print(f"Consistency check {i+1}/{CONSISTENCY_CHECKS}", file=original_stdout, flush=True)
-        
-        # If we have an audio stream, record from it. Otherwise use the function directly.
-        if audio_stream is not None:
-            frames = []
-            for _ in range(0, int(RATE / CHUNK * RECORD_SECONDS)):
-                data = audio_stream.read(CHUNK, exception_on_overflow=False)
-                frames.append(data)
-            audio_data = b''.join(frames)
-        else:
-            # Use the function directly as it will handle the audio data
-            audio_data = None
-        
-        # Always pass the audio data we have
-        artist, title, confidence = await recognize_song_func(audio_data)
+    song_counts = collections.Counter()
+    confidence_sums = {}
+    consistent = None
+    silent_checks = 0
+    semaphore = asyncio.Semaphore(SHAZAM_CONCURRENCY)
+
+    async def check(i, audio_data):
+        async with semaphore:
+            artist, title, confidence = await recognize_song_func(audio_data)
         if verbose:
             print(f"Check {i+1} result: {title} by {artist} (confidence: {confidence:.2f})", file=original_stdout, flush=True)
-        
-        if artist and title and artist != "None" and title != "None":
-            song_checks.append((artist, title))
-            confidence_scores.append(confidence)
-        
-        # Wait between checks to get different parts of the song
-        if i < CONSISTENCY_CHECKS - 1:  # Don't wait after the last check
+        return artist, title, confidence
+
+    def tally(done):
+        """Count finished checks, returning a song once it is consistent."""
+        for task in done:
+            if task.cancelled():
+                continue
+            if task.exception() is not None:
+                if verbose:
+                    print(f"Error in consistency check: {task.exception()}", file=original_stdout, flush=True)
+                continue
+            artist, title, confidence = task.result()
+            song = (artist, title)
+            if is_valid_song(song):
+                song_counts[song] += 1
+                confidence_sums[song] = confidence_sums.get(song, 0) + confidence
+                if song_counts[song] >= CONSISTENCY_THRESHOLD:
+                    return song
+        return None
+
+    if audio_source is not None:
+        windows = list(audio_source)
+        check_count = len(windows)
+    else:
+        windows = None
+        check_count = CONSISTENCY_CHECKS
+
+    tasks = []
+    pending = set()
+    try:
+        for i in range(check_count):
+            # Once enough finished checks agree, skip the remaining captures
+            done = {task for task in pending if task.done()}
+            pending -= done
+            consistent = tally(done)
+            if consistent:
+                break
+
             if verbose:
-                print(f"Waiting {CHECK_DELAY}s for next check...", file=original_stdout, flush=True)
-            await asyncio.sleep(CHECK_DELAY)
+                print(f"Consistency check {i+1}/{check_count}", file=original_stdout, flush=True)
+            
+            if windows is not None:
+                audio_data = windows[i]
+            # If we have an audio buffer, record from it. Otherwise use the function directly.
+            elif audio_buffer is not None:
+                audio_data = await audio_buffer.read(RECORD_SECONDS)
+            else:
+                # Use the function directly as it will handle the audio data
+                audio_data = None
+            
+            # A silent window can't be recognized, so don't spend a request on
+            # it, and stop once most of the checks have come back silent
+            if audio_data is not None and not any_above(audio_data, MIN_RECOGNITION_LEVEL):
+                silent_checks += 1
+                if verbose:
+                    print(f"Check {i+1} skipped: audio too quiet", file=original_stdout, flush=True)
+                if silent_checks * 2 > check_count:
+                    break
+                continue
+
+            # Always pass the audio data we have
+            task = asyncio.ensure_future(check(i, audio_data))
+            tasks.append(task)
+            pending.add(task)
+
+            # Captured windows already span different parts of the song
+            if windows is not None:
+                continue
+            
+            # Wait between checks to get different parts of the song
+            if i < CONSISTENCY_CHECKS - 1:  # Don't wait after the last check
+                if verbose:
+                    print(f"Waiting {CHECK_DELAY}s for next check...", file=original_stdout, flush=True)
+                await asyncio.sleep(CHECK_DELAY)
+
+        while pending and not consistent:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            consistent = tally(done)
+    finally:
+        for task in tasks:
+            task.cancel()
 
-        await asyncio.sleep(RECORD_SECONDS)
+    if consistent:
+        if verbose:
+            print(
+                f"Song detected: {consistent[1]} by {consistent[0]} "
+                f"({song_counts[consistent]}/{check_count} matches)",
+                file=original_stdout,
+                flush=True
+            )
+        return consistent
 
-    song_counts = collections.Counter(song_checks)
     most_common = song_counts.most_common(1)
     if most_common:
         # Accept any valid detection since we're using fixed confidence now
         if verbose:
             print(
                 f"Song detected: {most_common[0][0][1]} by {most_common[0][0][0]} "
-                f"({most_common[0][1]}/{CONSISTENCY_CHECKS} matches)",
+                f"({most_common[0][1]}/{check_count} matches)",
                 file=original_stdout,
                 flush=True
             )
         return most_common[0][0]
     
     if verbose:
-        if song_checks:
+        if song_counts:
             print("Inconsistent results detected:", file=original_stdout, flush=True)
             for song, count in song_counts.items():
                 print(f"  {song[1]} by {song[0]}: {count} matches", file=original_stdout, flush=True)
@@ -323,40 +813,80 @@ async def check_song_consistency(recognize_song_func, audio_stream, verbose, ori
             print("No songs detected", file=original_stdout, flush=True)
     return None, None
 
-async def aggressive_song_check(recognize_song_func, audio_stream, verbose, original_stdout):
+async def aggressive_song_check(recognize_song_func, audio_buffer, verbose, original_stdout):
     """Aggressively try to identify a song with quick successive checks.
 
+    Each window is sent for recognition as soon as it has been captured,
+    so the Shazam round trips overlap the remaining captures. At most
+    SHAZAM_CONCURRENCY requests are in flight at once, and capturing stops
+    as soon as one window is recognized.
+
     Args:
         recognize_song_func: Function to recognize songs
-        audio_stream: Audio stream to read from
+        audio_buffer: AudioRingBuffer fed by a callback stream
         verbose: Whether to print verbose output
         original_stdout: Original stdout for printing
 
     Returns:
         tuple: (artist, title) if song is recognized, (None, None) otherwise
     """
+    if audio_buffer is None:
+        return None, None
 
-    import collections
-    for i in range(AGGRESSIVE_CHECK_COUNT):
-        if verbose:
-            print(f"Aggressive check {i+1}/{AGGRESSIVE_CHECK_COUNT}", file=original_stdout, flush=True)
-        
-        # If we have an audio stream, record from it. Otherwise use the function directly.
-        if audio_stream is not None:
-            frames = []
-            for _ in range(0, int(RATE / CHUNK * RECORD_SECONDS)):
-                data = audio_stream.read(CHUNK, exception_on_overflow=False)
-                frames.append(data)
-            audio_data = b''.join(frames)
-            song = await check_song_consistency(recognize_song_func, audio_stream, verbose, original_stdout)
-        else:
-            # Use the function directly as it will handle the audio data
-            song = await check_song_consistency(recognize_song_func, None, verbose, original_stdout)
-        if song and song[0] and song[1] and song[0] != "None" and song[1] != "None":
-            return song
-        await asyncio.sleep(AGGRESSIVE_CHECK_INTERVAL)
-    
-    return None, None
+    semaphore = asyncio.Semaphore(SHAZAM_CONCURRENCY)
+
+    async def recognize(audio_data):
+        async with semaphore:
+            return await recognize_song_func(audio_data)
+
+    def first_song(tasks):
+        for task in tasks:
+            if task.done() and not task.cancelled() and task.exception() is None:
+                song = task.result()[:2]
+                if is_valid_song(song):
+                    return song
+        return None
+
+    tasks = []
+    try:
+        for i in range(AGGRESSIVE_CHECK_COUNT):
+            if verbose:
+                print(f"Aggressive check {i+1}/{AGGRESSIVE_CHECK_COUNT}", file=original_stdout, flush=True)
+            if i:
+                # Back off further if Shazam asked for it after a miss
+                await asyncio.sleep(max(AGGRESSIVE_CHECK_INTERVAL, shazam_retry_delay()))
+            if first_song(tasks):
+                break
+            audio_data = await audio_buffer.read(RECORD_SECONDS)
+            tasks.append(asyncio.ensure_future(recognize(audio_data)))
+
+        # Windows finish in any order; report the earliest one that matched
+        await asyncio.wait(tasks)
+        return first_song(tasks) or (None, None)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# Last known terminal width; re-queried at most every TERMINAL_SIZE_RECHECK
+# seconds, or on the next call after invalidate_terminal_size()
+TERMINAL_SIZE_RECHECK = 1.0
+_TERMINAL_SIZE = {"columns": None, "checked": 0.0}
+
+def invalidate_terminal_size(*_):
+    """Forget the cached terminal width, e.g. from a SIGWINCH handler."""
+    _TERMINAL_SIZE["columns"] = None
+
+def get_terminal_columns():
+    """Return the terminal width without a syscall on every redraw.
+
+    Returns:
+        int: Number of terminal columns
+    """
+    now = time.monotonic()
+    if _TERMINAL_SIZE["columns"] is None or now - _TERMINAL_SIZE["checked"] >= TERMINAL_SIZE_RECHECK:
+        _TERMINAL_SIZE["columns"] = shutil.get_terminal_size().columns
+        _TERMINAL_SIZE["checked"] = now
+    return _TERMINAL_SIZE["columns"]
 
 def display_tui_track_info(artist, title):
     """Display track information in a TUI-like format.
@@ -366,23 +896,15 @@ def display_tui_track_info(artist, title):
         title: Title of the song
     """
 
-    columns, _ = shutil.get_terminal_size()
-    box_width = max(len(artist), len(title)) + 14
-    if box_width > columns:
-        box_width = min(box_width, columns - 2)
-
-    top_bottom = "+" + "-" * (box_width - 2) + "+"
-    title_cut = max(box_width - 14, 1)
-    artist_cut = max(box_width - 13, 1)
-
-    title_line = f"| Now Playing: {title:<{title_cut}} |"
-    artist_line = f"| Artist:      {artist:<{artist_cut}} |"
-
-    box_lines = [top_bottom, title_line, artist_line, top_bottom]
+    columns = get_terminal_columns()
+    # Value column width; the box adds 17 characters of frame and labels
+    # and must leave a margin of two columns
+    width = max(1, min(max(len(artist), len(title)), columns - 19))
 
-    left_pad = max(0, (columns - box_width) // 2)
-    centered_output = []
-    for line in box_lines:
-        centered_output.append(" " * left_pad + line)
+    top_bottom = "+" + "-" * (width + 15) + "+"
+    title_line = f"| Now Playing: {title[:width]:<{width}} |"
+    artist_line = f"| Artist:      {artist[:width]:<{width}} |"
 
-    return "\n".join(centered_output)
\ No newline at end of file
+    # Every line has the same width, so one left pad centers the whole box
+    pad = " " * max(0, (columns - len(top_bottom)) // 2)
+    return pad + ("\n" + pad).join((top_bottom, title_line, artist_line, top_bottom))
\ No newline at end of file